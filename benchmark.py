@@ -0,0 +1,403 @@
+# Measures how long Stats.calculate_stats takes, and each of its steps, without
+# needing the real thesis. The documents are generated from a seed, so the same
+# sizes and seed always give the same text, and the numbers of different
+# versions of the code can be compared. Run as
+#   python benchmark.py --sizes 10 100 1000 --repeats 3
+# It also compares the ways of reading the metadata of all commits, on a
+# generated repository, with
+#   python benchmark.py --commit-log 10000
+
+import argparse
+import random
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+import pandas as pd
+
+from config import stats_basepath
+from repo_info import iter_commit_log
+from stage_profiler import StageProfiler
+from text_stats import Stats
+
+# Common Portuguese words, most of them stopwords, mixed with the generated ones
+function_words = (
+    "de a o que e do da em um para com não uma os no se na por mais as dos como "
+    "mas ao ele das à seu sua ou quando muito nos já também só pelo pela até isso "
+    "entre depois sem mesmo aos seus quem nas esse eles essa num nem suas meu às "
+    "pelos elas qual lhe deles essas esses pelas este foram há são foi ser tem"
+).split()
+
+# Syllables for the generated words, so they look (and stem) a bit like Portuguese
+syllables = (
+    "ca da ção men to pa ra que ões mi ce las gi gan tes vis co e lás ti pro pri "
+    "des re ló cas sur fac tan va ri á vel con cen tra so lu ní ve is tu do me di "
+    "al go rit mo por ta ge bi li za dor ma te ri fo tos po lí ê ci a"
+).split()
+
+word_endings = ("", "", "s", "es", "mente", "ado", "ada", "ados", "ção", "ções")
+
+
+def _generate_vocabulary(rng: random.Random, size: int) -> List[str]:
+    """Creates distinct Portuguese-looking words"""
+    vocabulary = set()
+    while len(vocabulary) < size:
+        word = "".join(rng.choices(syllables, k=rng.randint(2, 4)))
+        vocabulary.add(word + rng.choice(word_endings))
+    return sorted(vocabulary)
+
+
+def generate_document(
+    paragraphs: int = 100,
+    seed: int = 0,
+    vocabulary_size: int = 3000,
+    equation_rate: float = 0.3,
+    figure_rate: float = 0.15,
+    max_subfigures: int = 4,
+    citation_rate: float = 0.5,
+    listing_rate: float = 0.05,
+    comment_rate: float = 0.3,
+) -> str:
+    """Generates a LaTeX document that looks like a chapter of the thesis, with
+    Portuguese-like text, equations, figures with subfigures, citations,
+    listings and comments.
+
+        Args:
+            paragraphs (int, optional): size of the document, each paragraph
+            has a few hundred characters. Defaults to 100.
+            seed (int, optional): the same seed gives the same document.
+            Defaults to 0.
+            vocabulary_size (int, optional): number of distinct generated
+            words, which are used with a Zipf-like frequency. Defaults to 3000.
+            equation_rate (float, optional): probability of a paragraph having
+            an inline, display or numbered equation. Defaults to 0.3.
+            figure_rate (float, optional): probability of a figure after a
+            paragraph. Defaults to 0.15.
+            max_subfigures (int, optional): each figure has from 0 up to this
+            many subfigures. Defaults to 4.
+            citation_rate (float, optional): probability of a sentence having a
+            citation. Defaults to 0.5.
+            listing_rate (float, optional): probability of a listing after a
+            paragraph. Defaults to 0.05.
+            comment_rate (float, optional): probability of a paragraph having
+            comments. Defaults to 0.3.
+
+        Returns:
+            str: the document
+    """
+    rng = random.Random(seed)
+    vocabulary = _generate_vocabulary(rng, vocabulary_size)
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    counters = dict(figure=0, equation=0, listing=0, section=0)
+
+    def words(number: int) -> List[str]:
+        chosen = []
+        for _ in range(number):
+            if rng.random() < 0.4:
+                chosen.append(rng.choice(function_words))
+            else:
+                chosen.append(rng.choices(vocabulary, weights)[0])
+        return chosen
+
+    def citation() -> str:
+        keys = ",".join(
+            f"{rng.choice(vocabulary)}{rng.randint(1990, 2020)}"
+            for _ in range(rng.randint(1, 3))
+        )
+        return rng.choice((r"\cite{", r"\citeauthor{")) + keys + "}"
+
+    def sentence() -> str:
+        sentence_words = words(rng.randint(6, 20))
+        sentence_words[0] = sentence_words[0].capitalize()
+        extras = []
+        if rng.random() < citation_rate:
+            extras.append(citation())
+        if rng.random() < 0.1 and counters["figure"]:
+            extras.append(rf"(\autoref{{fig:{rng.randint(1, counters['figure'])}}})")
+        if rng.random() < 0.1:
+            extras.append(f"{rng.randint(1, 100)} °C")
+        if rng.random() < 0.05:
+            extras.append(f"{rng.randint(1, 99)}\\%")
+        if rng.random() < 0.05:
+            extras.append(rf"\index{{{rng.choice(vocabulary)}}}")
+        for extra in extras:
+            sentence_words.insert(rng.randint(1, len(sentence_words)), extra)
+        return " ".join(sentence_words) + "."
+
+    def equation() -> str:
+        variable = rng.choice((r"\eta", r"\tau", "G'", "c", r"\phi"))
+        kind = rng.random()
+        if kind < 0.5:
+            return rng.choice((f"${variable}_{{0}}$", rf"\({variable}^2\)"))
+        if kind < 0.75:
+            return rf"\[ {variable} = \frac{{{variable}_0}}{{1 + t}} \]"
+        counters["equation"] += 1
+        return (
+            "\\begin{equation}\n"
+            f"    {variable} = {variable}_0 \\exp(-t / \\tau)\n"
+            f"    \\label{{eq:{counters['equation']}}}\n"
+            "\\end{equation}"
+        )
+
+    def figure() -> str:
+        counters["figure"] += 1
+        lines = ["\\begin{figure}[h]", "    \\centering"]
+        subfigures = rng.randint(0, max_subfigures)
+        if subfigures == 0:
+            lines.append(
+                f"    \\includegraphics[width=\\textwidth]{{fig/img{counters['figure']}}}"
+            )
+        for i in range(subfigures):
+            lines += [
+                "    \\begin{subfigure}{0.45\\textwidth}",
+                f"        \\includegraphics[width=\\textwidth]{{fig/img{counters['figure']}-{i}}}",
+                f"        \\caption{{{' '.join(words(5))}}}",
+                f"        \\label{{fig:{counters['figure']}-{i}}}",
+                "    \\end{subfigure}",
+            ]
+        lines += [
+            f"    \\caption{{{' '.join(words(12))}}}",
+            f"    \\label{{fig:{counters['figure']}}}",
+            "\\end{figure}",
+        ]
+        return "\n".join(lines)
+
+    def listing() -> str:
+        counters["listing"] += 1
+        return (
+            "\\begin{listing}\n"
+            f"    \\inputminted{{python}}{{codigo/script{counters['listing']}.py}}\n"
+            f"    \\caption{{{' '.join(words(6))}}}\n"
+            "\\end{listing}"
+        )
+
+    pieces = [f"\\chapter{{{' '.join(words(3)).capitalize()}}}\n\\label{{cap:{seed}}}"]
+    for i in range(paragraphs):
+        if i % 8 == 0:
+            counters["section"] += 1
+            pieces.append(
+                f"\\section{{{' '.join(words(4)).capitalize()}}}\n"
+                f"\\label{{sec:{counters['section']}}}"
+            )
+        sentences = [sentence() for _ in range(rng.randint(2, 6))]
+        if rng.random() < equation_rate:
+            sentences.insert(rng.randint(0, len(sentences)), equation())
+        if rng.random() < comment_rate:
+            position = rng.randint(0, len(sentences) - 1)
+            sentences[position] += " % " + " ".join(words(6)) + "\n"
+        if rng.random() < comment_rate / 3:
+            sentences.insert(0, "% TODO: " + " ".join(words(8)) + "\n")
+        pieces.append(" ".join(sentences))
+        if rng.random() < figure_rate:
+            pieces.append(figure())
+        if rng.random() < listing_rate:
+            pieces.append(listing())
+    return "\n\n".join(pieces) + "\n"
+
+
+def benchmark_calculate_stats(
+    sizes: List[int] = (10, 100, 1000), repeats: int = 3, seed: int = 0
+) -> pd.DataFrame:
+    """Times Stats.calculate_stats and each of its steps on generated documents
+    of several sizes, with the lexer and with the regex substitutions.
+
+        Args:
+            sizes (List[int], optional): number of paragraphs of each document
+            (see generate_document). Defaults to (10, 100, 1000).
+            repeats (int, optional): each time is the best of this many runs.
+            The first run also fills the stem cache. Defaults to 3.
+            seed (int, optional): seed of the documents. Defaults to 0.
+
+        Returns:
+            pd.DataFrame: one row per size, method and step, with the seconds
+            and the characters per second. The step "calculate_stats" is the
+            total.
+    """
+    rows = []
+    use_lexer, profiler = Stats.use_lexer, Stats.profiler
+    try:
+        for paragraphs in sizes:
+            text = generate_document(paragraphs, seed)
+            for method, Stats.use_lexer in (("lexer", True), ("regexes", False)):
+                best = {}
+                for _ in range(repeats):
+                    Stats.profiler = StageProfiler()
+                    st = Stats("benchmark", text)
+                    start = time.perf_counter()
+                    st.calculate_stats()
+                    seconds = {"calculate_stats": time.perf_counter() - start}
+                    for record in Stats.profiler.records:
+                        seconds[record["stage"]] = record["seconds"]
+                    for stage, value in seconds.items():
+                        best[stage] = min(value, best.get(stage, value))
+                for stage, value in best.items():
+                    rows.append(
+                        dict(
+                            paragraphs=paragraphs,
+                            characters=len(text),
+                            method=method,
+                            stage=stage,
+                            seconds=value,
+                            chars_per_second=len(text) / value if value else None,
+                        )
+                    )
+                print(
+                    f"{paragraphs} paragraphs ({len(text)} characters), {method}:",
+                    f"{best['calculate_stats']:.3f} s",
+                    flush=True,
+                )
+    finally:
+        Stats.use_lexer, Stats.profiler = use_lexer, profiler
+    return pd.DataFrame(rows)
+
+
+def generate_repository(path: str, commits: int = 10000, seed: int = 0) -> None:
+    """Creates a git repository with a linear history of small edits to a few
+    .tex files, like the thesis, using git fast-import so that thousands of
+    commits take a few seconds.
+
+        Args:
+            path (str): folder of the new repository
+            commits (int, optional): number of commits. Defaults to 10000.
+            seed (int, optional): seed of the messages and edits. Defaults to 0.
+    """
+    rng = random.Random(seed)
+    vocabulary = _generate_vocabulary(rng, 500)
+    chapters = {f"cap{i}.tex": [] for i in range(1, 6)}
+    subprocess.run(["git", "init", "-q", "-b", "master", path], check=True)
+    stream = []
+    for i in range(commits):
+        name = rng.choice(list(chapters))
+        line = " ".join(rng.choices(vocabulary, k=rng.randint(5, 15)))
+        # Chapters grow up to 100 lines, then lines are rewritten
+        if len(chapters[name]) < 100:
+            chapters[name].append(line)
+        else:
+            chapters[name][rng.randrange(100)] = line
+        content = ("\n".join(chapters[name]) + "\n").encode("utf8")
+        # Some messages have the characters that broke the old commit list
+        message = f"Commit {i}; {' '.join(rng.choices(vocabulary, k=3))}"
+        if rng.random() < 0.1:
+            message += "\n\nMore details; on another line"
+        message = message.encode("utf8")
+        date = 1500000000 + i * 600
+        stream.append(b"commit refs/heads/master\n")
+        stream.append(f"committer A <a@b.c> {date} +0000\n".encode())
+        stream.append(f"data {len(message)}\n".encode() + message + b"\n")
+        stream.append(f"M 100644 inline {name}\n".encode())
+        stream.append(f"data {len(content)}\n".encode() + content + b"\n")
+    subprocess.run(
+        ["git", "fast-import", "--quiet"], input=b"".join(stream), cwd=path, check=True
+    )
+    subprocess.run(["git", "checkout", "-q", "master"], cwd=path, check=True)
+
+
+def _commit_list_gitpython(path: str, changed: bool = False) -> list:
+    """The metadata of all commits, the way create_commit_list used to read
+    it, one GitPython object at a time, and, if `changed`, a git diff-tree
+    for the changed paths of each commit"""
+    import git
+
+    repo = git.Repo(path)
+    commits = []
+    for commit in repo.iter_commits("master"):
+        commits.append(
+            {
+                "sha": commit.hexsha,
+                "message": commit.message.rstrip(),
+                "time": commit.committed_date,
+                "parents": [parent.hexsha for parent in commit.parents],
+                "tree": commit.tree.hexsha,
+            }
+        )
+        if changed:
+            commits[-1]["changed"] = repo.git.diff_tree(
+                "-r", "--name-only", "-z", "--no-commit-id", "--root", commit.hexsha
+            ).split("\0")
+    return commits
+
+
+def benchmark_commit_log(commits: int = 10000, repeats: int = 3) -> pd.DataFrame:
+    """Times reading the metadata of every commit of a generated repository
+    with GitPython, with or without a git diff-tree per commit for the
+    changed paths, and with a single git log (repo_info.iter_commit_log), with
+    the changed paths or also the lines added and deleted.
+
+        Args:
+            commits (int, optional): size of the repository. Defaults to 10000.
+            repeats (int, optional): each time is the best of this many runs.
+            Defaults to 3.
+
+        Returns:
+            pd.DataFrame: one row per method, with the seconds and commits per
+            second
+    """
+    rows = []
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        generate_repository(path, commits)
+        print(f"Generated {commits} commits in {time.perf_counter() - start:.1f} s")
+        methods = dict(
+            gitpython=lambda: _commit_list_gitpython(path),
+            gitpython_changed_paths=lambda: _commit_list_gitpython(path, True),
+            git_log_changed_paths=lambda: list(
+                iter_commit_log(["master"], path, numstat=False)
+            ),
+            git_log_numstat=lambda: list(iter_commit_log(["master"], path)),
+        )
+        for method, function in methods.items():
+            best = None
+            for _ in range(repeats):
+                start = time.perf_counter()
+                found = len(function())
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+            rows.append(
+                dict(
+                    method=method,
+                    commits=found,
+                    seconds=best,
+                    commits_per_second=found / best,
+                )
+            )
+            print(f"{method}: {best:.3f} s for {found} commits", flush=True)
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Times Stats.calculate_stats on generated documents, or "
+        "reading the commits of a generated repository"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument(
+        "--commit-log",
+        type=int,
+        metavar="COMMITS",
+        help="times reading the commits of a generated repository of this size "
+        "instead",
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", default=str(Path(stats_basepath) / "benchmark.csv")
+    )
+    arguments = parser.parse_args()
+    if arguments.commit_log:
+        table = benchmark_commit_log(arguments.commit_log, arguments.repeats)
+        table.to_csv(
+            Path(arguments.output).with_name("benchmark_commit_log.csv"), index=False
+        )
+        print(table.to_string())
+    else:
+        table = benchmark_calculate_stats(
+            arguments.sizes, arguments.repeats, arguments.seed
+        )
+        table.to_csv(arguments.output, index=False)
+        print(
+            table.pivot_table(
+                index="stage", columns=["paragraphs", "method"], values="seconds"
+            ).to_string()
+        )
@@ -8,6 +8,8 @@ from config import pdf_pages_path, collated_pdfs_path, compiled_pdfs_path
 from pathlib import Path
 from typing import Tuple
 from repo_info import load_commit_list
+from content_hash import content_hashes, link_artifact
+from latex_manip import compile_hash
 
 
 def add_border(image: np.ndarray, width: int = 1) -> np.ndarray:
@@ -255,7 +257,10 @@ def compress_image(sha: str, quality: float = 10) -> None:
 
 
 def compress_all_images() -> None:
-    uncompressed = Path(collated_pdfs_path).glob("*png")
+    selected = {commit["sha"] for commit in load_commit_list()}
+    uncompressed = [
+        file for file in Path(collated_pdfs_path).glob("*png") if file.stem in selected
+    ]
     for file in uncompressed:
         sha = file.stem
         print("Compressing", sha, "...", end="", flush=True)
@@ -264,19 +269,36 @@ def compress_all_images() -> None:
 
 
 def collate_all() -> None:
-    """Goes through every commit and collates their individual .pngs into a single, large image"""
+    """Goes through every commit and collates their individual .pngs into a
+    single, large image. Commits with the same sources as one already collated
+    (see latex_manip.compile_hash) get a link to its image instead."""
     commits = load_commit_list()
+    hashes = content_hashes([commit["sha"] for commit in commits], compile_hash)
+    collated = {}
+    for sha, key in hashes.items():
+        image = Path(collated_pdfs_path) / (sha + ".png")
+        if key is not None and image.is_file():
+            collated.setdefault(key, image)
+
     for i, commit in enumerate(commits):
         print(
             f"({i+1}/{len(commits)}): Merging {commit['sha']}...",
             end="",
             flush=True,
         )
-        if (Path(collated_pdfs_path) / (commit["sha"] + ".png")).is_file():
+        image = Path(collated_pdfs_path) / (commit["sha"] + ".png")
+        key = hashes[commit["sha"]]
+        if image.is_file():
             print(" Already processed, skipping.", flush=True)
             continue
+        if key in collated:
+            link_artifact(collated[key], image)
+            print(f" Same as {collated[key].stem}, linked.", flush=True)
+            continue
         # Hard coded because these seem to be the better size for my case
         collate_pdf_by_sha(commit["sha"], rows=15, cols=25)
+        if key is not None:
+            collated[key] = image
         print(" Done.", flush=True)
 
 
@@ -310,10 +332,35 @@ def dismember_pdf_images_from_sha(sha: str, dpi: int = 50) -> None:
 
 
 def dismember_all_pdfs() -> None:
-    """Dismembers all compiled pdfs"""
-    pdf_files = glob.glob(compiled_pdfs_path + "/*pdf")
-    # pdf_files = glob.glob(compiled_pdfs_path + "/*pdf")
+    """Dismembers all compiled pdfs. Pdfs of commits with the same sources as
+    one already dismembered (see latex_manip.compile_hash) get links to its
+    images instead. Only the commits of load_commit_list are used, see
+    commit_sampling."""
+    selected = {commit["sha"] for commit in load_commit_list()}
+    pdf_files = [
+        file
+        for file in glob.glob(compiled_pdfs_path + "/*pdf")
+        if Path(file).stem in selected
+    ]
+    hashes = content_hashes([Path(file).stem for file in pdf_files], compile_hash)
+    dismembered = {}
+    for sha, key in hashes.items():
+        pages = Path(pdf_pages_path) / sha
+        if key is not None and pages.is_dir() and any(pages.glob("*png")):
+            dismembered.setdefault(key, pages)
+
     for i, file in enumerate(pdf_files):
         print(f"({i+1}:{len(pdf_files)}) Dismembering", file)
         pdf_path = Path(file)
+        pages = Path(pdf_pages_path) / pdf_path.stem
+        key = hashes[pdf_path.stem]
+        if pages.is_dir() and any(pages.glob("*png")):
+            print("\tAlready dismembered, skipping")
+            continue
+        if key in dismembered:
+            print(f"\tSame as {dismembered[key].name}, linking")
+            link_artifact(dismembered[key], pages)
+            continue
         dismember_pdf_images_from_sha(pdf_path.stem, dpi=50)
+        if key is not None:
+            dismembered[key] = pages
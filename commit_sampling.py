@@ -0,0 +1,166 @@
+# Most commits of a long history are small fixes, and processing all of them
+# makes every stage slow. A sampling policy chooses which commits are used, and
+# is applied by load_commit_list, so all the stages (stats, pdfs, images,
+# frames) use the same commits. The policy is given as a text in the
+# environment variable EVOLUTION_SAMPLING, or with `python main.py --sampling`:
+#   bucket:7d    at most one commit per week (units s, m, h, d, w), the last one
+#   words:200    only commits whose word count changed by more than 200 words
+#                since the last one kept. Needs the stats of the commits, the
+#                ones without stats are kept.
+#   frames:300   300 commits, evenly spread over the history
+# The first and the last commits are always kept. The stats graph of the frames
+# is drawn from the stats store, so to show the whole history in it, create the
+# stats without sampling and then make the frames with a policy.
+
+import os
+from typing import Callable, Dict, List
+
+sampling_variable = "EVOLUTION_SAMPLING"
+
+time_units = dict(s=1, m=60, h=60 * 60, d=24 * 60 * 60, w=7 * 24 * 60 * 60)
+
+
+def one_per_bucket(commits: List[dict], seconds: int) -> List[dict]:
+    """Keeps the last commit of each period of `seconds`, so the state of the
+    text at the end of each day, week, etc.
+
+        Args:
+            commits (List[dict]): from the oldest to the newest, as in
+            load_commit_list
+            seconds (int): size of the period
+
+        Returns:
+            List[dict]: the commits kept, in the same order
+    """
+    last_of_bucket: Dict[int, dict] = {}
+    for commit in commits:
+        last_of_bucket[int(commit["time"]) // seconds] = commit
+    kept = {id(commit) for commit in last_of_bucket.values()}
+    return [
+        commit
+        for i, commit in enumerate(commits)
+        if id(commit) in kept or i == 0
+    ]
+
+
+def word_count_change(
+    commits: List[dict], threshold: int, word_counts: Dict[str, int] = None
+) -> List[dict]:
+    """Keeps the commits whose word count differs by more than `threshold`
+    from the last commit kept.
+
+        Args:
+            commits (List[dict]): from the oldest to the newest
+            threshold (int): number of words
+            word_counts (Dict[str, int], optional): sha -> word count. Defaults
+            to the word counts in the stats store. Commits without a word
+            count are kept.
+
+        Returns:
+            List[dict]: the commits kept, in the same order
+    """
+    if word_counts is None:
+        word_counts = _stored_word_counts()
+    kept = []
+    last_count = None
+    for i, commit in enumerate(commits):
+        count = word_counts.get(commit["sha"])
+        if (
+            count is None
+            or last_count is None
+            or abs(count - last_count) > threshold
+            or i == len(commits) - 1
+        ):
+            kept.append(commit)
+            if count is not None:
+                last_count = count
+    return kept
+
+
+def evenly_spread(commits: List[dict], number: int) -> List[dict]:
+    """Keeps `number` commits, evenly spread by their position in the
+    history, e.g. for a video with a fixed number of frames.
+
+        Args:
+            commits (List[dict]): from the oldest to the newest
+            number (int): commits to keep, at least 2
+
+        Returns:
+            List[dict]: the commits kept, in the same order
+    """
+    if number >= len(commits):
+        return list(commits)
+    if number < 2:
+        raise ValueError("At least 2 commits have to be kept, the first and the last")
+    positions = sorted(
+        {round(i * (len(commits) - 1) / (number - 1)) for i in range(number)}
+    )
+    return [commits[position] for position in positions]
+
+
+def _stored_word_counts() -> Dict[str, int]:
+    from config import stats_basepath
+    from pathlib import Path
+
+    if not (Path(stats_basepath) / "stats.sqlite").is_file():
+        print("No stats yet, every commit is kept by the words sampling")
+        return {}
+    from stats_store import StatsStore
+
+    with StatsStore() as store:
+        return store.load_columns(["word_count"])["word_count"].to_dict()
+
+
+def parse_policy(text: str) -> Callable[[List[dict]], List[dict]]:
+    """Converts a policy written as text (see the top of this file) into a
+    function that samples a list of commits, from the oldest to the newest."""
+    kind, _, value = text.strip().partition(":")
+    unit = "s"
+    if kind == "bucket" and value[-1:] in time_units:
+        unit, value = value[-1], value[:-1]
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    if kind not in ("bucket", "words", "frames") or number is None:
+        raise ValueError(
+            f"Unknown sampling policy {text!r}, use bucket:<number><s|m|h|d|w>, "
+            "words:<number> or frames:<number>"
+        )
+    if kind == "bucket":
+        seconds = number * time_units[unit]
+        if seconds < 1:
+            raise ValueError(f"The buckets of {text!r} must be at least 1s")
+        return lambda commits: one_per_bucket(commits, seconds)
+    if kind == "words":
+        if number < 0:
+            raise ValueError(f"The words of {text!r} can't be negative")
+        return lambda commits: word_count_change(commits, number)
+    if number < 2:
+        raise ValueError(
+            f"{text!r} must keep at least 2 frames, the first and the last commits"
+        )
+    return lambda commits: evenly_spread(commits, number)
+
+
+def sample_commits(commits: List[dict], policy: str = None) -> List[dict]:
+    """Applies a sampling policy to the commits of load_commit_list.
+
+        Args:
+            commits (List[dict]): from the newest to the oldest, as returned
+            by load_commit_list
+            policy (str, optional): e.g. "bucket:1d". Defaults to the
+            environment variable EVOLUTION_SAMPLING. Empty or "all" keeps
+            every commit.
+
+        Returns:
+            List[dict]: the commits kept, from the newest to the oldest
+    """
+    if policy is None:
+        policy = os.environ.get(sampling_variable, "")
+    if policy.strip() in ("", "all"):
+        return commits
+    oldest_first = list(reversed(commits))
+    kept = parse_policy(policy)(oldest_first)
+    print(f"Sampling {policy}: {len(kept)} of {len(commits)} commits")
+    return list(reversed(kept))
@@ -1,7 +1,10 @@
 # TODO: Change these to pathlib.Path
 thesis_path = "../Tese"
 stats_basepath = "./stats"
+stats_cache_path = "./stats_cache"
 compiled_pdfs_path = "./pdfs"
 pdf_pages_path = "./imgs"
 collated_pdfs_path = "./collated"
 frames_path = "./frames"
+worktrees_path = "./worktrees"
+compile_cache_path = "./compile_cache"
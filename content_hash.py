@@ -0,0 +1,77 @@
+# Many commits don't change the files a stage reads (e.g. only images or the
+# .bib changed for the Stats), so they would give the same output again. Each
+# stage keys its outputs on a hash of the files it actually reads: the .tex
+# files for the Stats, and the whole source tree for the pdfs and the images
+# made from them. A commit with the same hash as one already processed gets
+# the existing outputs, linked, instead of calculating them again.
+
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Union
+
+from config import thesis_path
+from repo_info import BlobReader
+
+
+def source_tree_hash(reader: BlobReader, sha: str) -> str:
+    """The sha of the root tree of a commit, which git already calculates from
+    the contents of every file"""
+    tree_sha, _, _ = reader.read(sha + "^{tree}")
+    return tree_sha
+
+
+def tex_tree_hash(
+    reader: BlobReader, sha: str, filename_pattern: str = "*.tex"
+) -> str:
+    """Hash of the names and blob shas of the files create_stats_from_sha
+    reads from a commit, in the order they are read"""
+    digest = hashlib.sha1()
+    for name, blob_sha in reader.list_sources(sha, filename_pattern):
+        digest.update(f"{name}\0{blob_sha}\n".encode("utf8"))
+    return digest.hexdigest()
+
+
+def content_hashes(
+    shas: Iterable[str],
+    hash_function: Callable[[BlobReader, str], str],
+    repo_path: str = thesis_path,
+) -> Dict[str, str]:
+    """Calculates the hash of each commit with one BlobReader.
+
+        Args:
+            shas (Iterable[str]): the commits
+            hash_function (Callable): e.g. tex_tree_hash or source_tree_hash
+            repo_path (str, optional): Defaults to thesis_path.
+
+        Returns:
+            Dict[str, str]: sha -> hash, in the same order. Commits that
+            aren't in the repository get None.
+    """
+    hashes = {}
+    with BlobReader(repo_path) as reader:
+        for sha in shas:
+            try:
+                hashes[sha] = hash_function(reader, sha)
+            except KeyError:
+                hashes[sha] = None
+    return hashes
+
+
+def link_artifact(source: Union[str, Path], destination: Union[str, Path]) -> None:
+    """Hard links a file, or every file of a folder, to the destination, so
+    the output is stored only once. Copies when linking isn't possible, e.g.
+    between drives."""
+    source, destination = Path(source), Path(destination)
+    if source.is_dir():
+        os.makedirs(destination, exist_ok=True)
+        for file in source.iterdir():
+            link_artifact(file, destination / file.name)
+        return
+    if destination.exists():
+        destination.unlink()
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
@@ -18,8 +18,9 @@ from config import *
 from text_stats import (
     Stats,
     open_file,
-    fix_specific_things,
 )
+from stats_store import StatsStore
+from repo_info import load_commit_list
 
 PIL.Image.MAX_IMAGE_PIXELS = 933120000
 
@@ -665,14 +666,18 @@ def add_header(
 
 def create_all_graphs() -> None:
     """Creates a figure containing all the graphs and saves it to frames_path."""
-    # Loads all the pickled Stats files
-    files = Path(stats_basepath).glob("*.pkl")
-    list_of_Stats = []
-    for file in files:
-        with open(file, "rb") as fhand:
-            st = pickle.load(fhand)
-            list_of_Stats.append(st)
-    list_of_Stats.sort(key=lambda x: x.date)
+    # Loads only what the frames use from the stats store, sorted by date
+    with StatsStore() as store:
+        list_of_Stats = store.load_Stats(
+            columns=[
+                "date",
+                "word_count",
+                "unique_word_count",
+                "figure_count",
+                "equation_counts",
+                "table_count",
+            ]
+        )
 
     # Creates a standard for the wordclouds that will be created
     wc_kws = dict(
@@ -693,14 +698,24 @@ def create_all_graphs() -> None:
     # Hardcoded to -2 because my last commit is unrelated to the writing process
     reference_wc = sum(list_of_Stats[-2].reduced_word_Counter.values())
 
-    starting_stat = fix_specific_things(list_of_Stats[0])
+    starting_stat = list_of_Stats[0]
     previous_message = ""
+    # Frames are only made for the commits chosen by the sampling policy (see
+    # commit_sampling). The stats graph shows the commits in the stats store,
+    # which are the ones sampled when the stats were created, so it only shows
+    # the whole history if the stats stage was run without sampling
+    selected = {commit["sha"] for commit in load_commit_list()}
+    frame = 0
 
     # Start of figure creation
     for i, stat in enumerate(list_of_Stats):
         sha = stat.commit_hash
+        message = commit_status_messages.get(stat.commit_hash, None)
+        if message:
+            previous_message = message
+        if sha not in selected:
+            continue
         # sha '714fad5902cfb17cf54633e4dba4314a74675047' is almost a repeat, but removing it is not necessary
-        stat = fix_specific_things(stat)
         fig, ax_text, ax_header, ax_stats, ax_wc = create_frame()
 
         # First, fill in the Text axis
@@ -710,17 +725,11 @@ def create_all_graphs() -> None:
         ax_text.imshow(fig_text)
 
         # Next, fill in the header.
-        message = commit_status_messages.get(stat.commit_hash, None)
-        if not message:
-            message = previous_message
-        else:
-            previous_message = message
-
         add_header(
             ax_header,
             starting_stat,
             stat,
-            message=message,
+            message=previous_message,
         )
         # Then create the Stats graph
         # Creates and plots the stats graph using every stat up to the current one
@@ -741,9 +750,10 @@ def create_all_graphs() -> None:
         )
         _ = add_wordcloud(ax_wc, scaled_cl)
 
-        fig.savefig(Path(frames_path) / f"{i:03d}.png", dpi=300)
+        fig.savefig(Path(frames_path) / f"{frame:03d}.png", dpi=300)
         plt.close(fig)
-        print(f"Processed {i:03d}", flush=True)
+        print(f"Processed {frame:03d}", flush=True)
+        frame += 1
 
 
 # Functions to test stuff
@@ -774,7 +784,6 @@ def create_test_Stat(output_filename: str = "test_stats.pkl") -> None:
     )
     st.debug = False
     st.calculate_stats()
-    st = fix_specific_things(st)
     with open(output_filename, "wb") as fhand:
         pickle.dump(st, fhand)
 
@@ -797,12 +806,8 @@ def test_wordcloud(pickle_path: str = "test_stats.pkl") -> None:
 
 
 def test_stats_graph():
-    files = list(Path(stats_basepath).glob("*.pkl"))
-    list_of_Stats = []
-    for file in files:
-        with open(file, "rb") as fhand:
-            st = pickle.load(fhand)
-            list_of_Stats.append(st)
+    with StatsStore() as store:
+        list_of_Stats = store.load_Stats(word_counts=False)
     list_of_Stats.sort(key=lambda x: x.date, reverse=True)
     fig, ax_text, ax_header, ax_stats, ax_wc = create_frame()
     add_stats_graph(ax_stats, list_of_Stats[2:])
@@ -811,13 +816,8 @@ def test_stats_graph():
 
 
 def test_header():
-    files = glob.glob("./stats/*.pkl")
-    list_of_Stats = []
-    for file in files:
-        with open(file, "rb") as fhand:
-            st = pickle.load(fhand)
-            list_of_Stats.append(st)
-    list_of_Stats.sort(key=lambda x: x.date)
+    with StatsStore() as store:
+        list_of_Stats = store.load_Stats(word_counts=False)
 
     reference_Stat = list_of_Stats[0]  # First one
 
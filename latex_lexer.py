@@ -0,0 +1,430 @@
+# Single pass tokenizer for the LaTeX sources, used by Stats.calculate_stats.
+# It produces the same counters as the chain of regex substitutions of the Stats
+# class, but instead of running each pattern over the whole document, the text
+# is scanned once for the characters that can start something interesting
+# (commands, "\(", "\[" and "$"). Each pattern of the Stats class is then only
+# tried where such a token starts, and a pattern that fails to close on a line
+# isn't searched for again on that line (see LineMatcher), so the cost is linear
+# on the size of the document. Things are removed outermost first, in the order
+# they appear, while the regex substitutions remove one kind of command at a
+# time. So the results differ when a delimiter is matched with the one of a
+# later command that the substitutions would have removed first:
+#  - a stray $ pairs with one after another command (e.g. "custa \$5 ... \[ x \]");
+#  - an unclosed brace is closed by a later command on the same line, e.g. in
+#    "\cite{x b \label{y} c" the lexer removes "b", the regexes keep it;
+#  - the greedy options of \ref[...] end at the last ] of the line, e.g. in
+#    "\ref[x] b \includegraphics[w]{f} c" the lexer removes "b" too.
+# With balanced delimiters and no \ref[...] before another ] on the same line,
+# the results are the same.
+# Environments are parsed once into a tree (see parse_environments), which gives
+# the figures, subfigures and equations their ends. An environment ends at its
+# matching \end, so when they are unbalanced the results differ from the lazy
+# regexes, which stopped at the first \end with the same name.
+
+import re
+from typing import List, Tuple
+
+# Regex translation: from the first % that is not escaped until the end of the
+# line. Same as Stats.remove_comments, but in one go for the whole text.
+comment_regex = re.compile(r"(?<!\\)%.*")
+
+# Regex translation: a latex command, "\(", "\[" or a dollar sign.
+token_regex = re.compile(r"\\(?:\w+|[\[(])|\$")
+
+# Regex translation: words not escaped by \ and not between {}. Used by
+# Stats.tokenize_text on the clean text.
+word_regex = re.compile(r"(?<!\\)(?<!{)\b\w+\b(?!})")
+
+# The patterns below are the same ones used by the methods of Stats, but they
+# are only ever matched at the position of a token.
+env_name_regex = re.compile(r"\\begin(?:\[.*?\])?{(\w+)}")
+cite_regex = re.compile(r"\\cite(?:author)?({.*?})?")
+dollar_eq_regex = re.compile(r"\$?\$(?:.+?)\$\$?", flags=re.DOTALL)
+inline_eq_regex = re.compile(r"\\\(.+?\\\)")
+display_eq_regex = re.compile(r"\\\[.*?\\\]", flags=re.DOTALL)
+includegraphics_regex = re.compile(r"\\includegraphics(\[.*?\])?({.*?})")
+label_regex = re.compile(r"\\label({.*?})")
+index_regex = re.compile(r"\\index({.*?})")
+ref_regex = re.compile(r"\\(auto)?ref(\[.*\])?({.*?})?")
+inputminted_regex = re.compile(r"\\inputminted{python}{.*?}")
+
+# Commands whose text is removed before counting words, in the order
+# Stats.calculate_stats removes them.
+removed_commands = {
+    r"\includegraphics": includegraphics_regex,
+    r"\label": label_regex,
+    r"\index": index_regex,
+    r"\inputminted": inputminted_regex,
+}
+
+
+# Regex translation: \begin or \end, perhaps with [...], and the name of the
+# environment between {}.
+environment_regex = re.compile(r"\\(begin|end)(?:\[.*?\])?{([^{}]*)}")
+# Where environment_regex can start
+environment_start_regex = re.compile(r"\\(?:begin|end)")
+
+# The patterns that search the rest of the line for a closing delimiter, with
+# the delimiters they can't match without, and their optional parts, with the
+# delimiter each part needs. See LineMatcher.
+line_delimiters = {
+    inline_eq_regex: (("\\)",), ()),
+    cite_regex: ((), (("{.*?}", "}"),)),
+    includegraphics_regex: (("}",), ((r"\[.*?\]", "]"),)),
+    label_regex: (("}",), ()),
+    index_regex: (("}",), ()),
+    inputminted_regex: (("}",), ()),
+    ref_regex: ((), ((r"\[.*\]", "]"), ("{.*?}", "}"))),
+    env_name_regex: ((), ((r"\[.*?\]", "]"),)),
+    environment_regex: ((), ((r"\[.*?\]", "]"),)),
+}
+
+
+class LineMatcher:
+    """Matches the patterns of line_delimiters at the positions of the tokens
+    of a text, in linear time. Tried at each token, a pattern like
+    \\label({.*?}) searches the rest of the line for the }, so on a line
+    with an unclosed \\label{, every later \\label would search the line
+    again. Instead, the next position of each delimiter is remembered, and
+    only searched again once the tokens go past it. A pattern is not tried
+    when one of its delimiters isn't in the rest of the line, and its optional
+    parts whose delimiter isn't there are replaced by a part that never
+    matches, so the match is the same, without the search. The DOTALL
+    patterns (the $ and \\[ equations) search the whole text instead, so
+    once they fail, they fail at every later token too.
+
+    The positions asked for must mostly increase, as the tokens do."""
+
+    # (pattern, optional parts left out) -> the pattern without them
+    _variants = {}
+
+    def __init__(self, text: str):
+        self.text = text
+        # Delimiter -> (position searched from, position found, -1 if none)
+        self._next = {}
+        # DOTALL pattern -> it doesn't match anymore
+        self._failed = set()
+
+    def next_position(self, delimiter: str, position: int) -> int:
+        """Position of the next delimiter from `position`, the length of the
+        text if there's none"""
+        searched_from, found = self._next.get(delimiter, (None, -1))
+        if searched_from is None or position < searched_from or 0 <= found < position:
+            found = self.text.find(delimiter, position)
+            self._next[delimiter] = (position, found)
+        return len(self.text) if found == -1 else found
+
+    def in_line(self, delimiter: str, position: int) -> bool:
+        """Whether the delimiter is between `position` and the end of its line"""
+        return self.next_position(delimiter, position) < self.next_position(
+            "\n", position
+        )
+
+    @classmethod
+    def _without(cls, regex, parts: frozenset):
+        key = (regex, parts)
+        if key not in cls._variants:
+            pattern = regex.pattern
+            for part in parts:
+                assert pattern.count(part) == 1, (pattern, part)
+                pattern = pattern.replace(part, "(?!)")
+            cls._variants[key] = re.compile(pattern, regex.flags)
+        return cls._variants[key]
+
+    def match(self, regex, position: int):
+        """Same as regex.match(text, position)"""
+        if regex in self._failed:
+            return None
+        required, optional = line_delimiters.get(regex, ((), ()))
+        for delimiter in required:
+            if not self.in_line(delimiter, position):
+                return None
+        missing = frozenset(
+            part
+            for part, delimiter in optional
+            if not self.in_line(delimiter, position)
+        )
+        found = (self._without(regex, missing) if missing else regex).match(
+            self.text, position
+        )
+        if found is None and regex.flags & re.DOTALL:
+            self._failed.add(regex)
+        return found
+
+
+class Environment:
+    """One environment of a document, from \\begin{name} to the end of
+    \\end{name}, with the environments inside it. The root of the tree (see
+    parse_environments) is the whole document, with name None."""
+
+    __slots__ = ("name", "start", "end", "parent", "children")
+
+    def __init__(self, name: str, start: int, parent: "Environment" = None):
+        self.name = name
+        self.start = start
+        # Stays None if the environment is never closed
+        self.end = None
+        self.parent = parent
+        self.children = []
+
+    def __repr__(self) -> str:
+        return f"Environment({self.name!r}, {self.start}, {self.end})"
+
+    @property
+    def closed(self) -> bool:
+        return self.end is not None
+
+    def walk(self):
+        """Yields all the environments inside this one, in the order they
+        begin in the text"""
+        stack = list(reversed(self.children))
+        while stack:
+            environment = stack.pop()
+            yield environment
+            stack.extend(reversed(environment.children))
+
+    def find(self, *names: str) -> List["Environment"]:
+        """All the closed environments inside this one with one of the names,
+        starred or not. E.g. root.find("figure") has the figure and figure*
+        environments of the document."""
+        return [
+            environment
+            for environment in self.walk()
+            if environment.closed and environment.name.rstrip("*") in names
+        ]
+
+    def inside(self, *names: str) -> bool:
+        """Whether this environment is inside one with one of the names, e.g.
+        listing.inside("appendices")"""
+        parent = self.parent
+        while parent is not None:
+            if parent.name is not None and parent.name.rstrip("*") in names:
+                return True
+            parent = parent.parent
+        return False
+
+    def outermost(self, *names: str) -> List["Environment"]:
+        """The environments with one of the names (see find) that are not
+        inside another one of them"""
+        outermost = []
+        for environment in self.find(*names):
+            if outermost and environment.start < outermost[-1].end:
+                continue
+            outermost.append(environment)
+        return outermost
+
+    def spans(self, *names: str) -> List[Tuple[int, int]]:
+        """Start and end of the outermost environments with one of the names,
+        so the text of each span can be removed without overlaps."""
+        return [
+            (environment.start, environment.end)
+            for environment in self.outermost(*names)
+        ]
+
+
+def parse_environments(text: str) -> Environment:
+    """Finds all \\begin{...} and \\end{...} of a text at once, and nests
+    them into a tree. An \\end closes the innermost environment with the same
+    name, and the ones opened after it are left unclosed. An \\end without a
+    \\begin is ignored.
+
+        Args:
+            text (str): the text, usually without comments
+
+        Returns:
+            Environment: the root, spanning the whole text
+    """
+    root = Environment(None, 0)
+    root.end = len(text)
+    open_environments = [root]
+    matcher = LineMatcher(text)
+    # Same as environment_regex.finditer(text), see LineMatcher
+    matched_until = 0
+    for start in environment_start_regex.finditer(text):
+        if start.start() < matched_until:
+            continue
+        match = matcher.match(environment_regex, start.start())
+        if match is None:
+            continue
+        matched_until = match.end()
+        kind, name = match.groups()
+        if kind == "begin":
+            environment = Environment(name, match.start(), open_environments[-1])
+            open_environments[-1].children.append(environment)
+            open_environments.append(environment)
+            continue
+        for i in range(len(open_environments) - 1, 0, -1):
+            if open_environments[i].name == name:
+                open_environments[i].end = match.end()
+                del open_environments[i:]
+                break
+    return root
+
+
+def remove_spans(text: str, spans: List[Tuple[int, int]]) -> str:
+    """Removes the parts of the text between each start and end, which must
+    be sorted and not overlap (see Environment.spans)"""
+    pieces = []
+    previous_end = 0
+    for start, end in spans:
+        pieces.append(text[previous_end:start])
+        previous_end = end
+    pieces.append(text[previous_end:])
+    return "".join(pieces)
+
+
+def remove_comments(text: str) -> str:
+    """Removes comments, like Stats.remove_comments"""
+    return comment_regex.sub("", text)
+
+
+def lex(text: str) -> dict:
+    """Goes through a text without comments once and calculates everything
+    Stats.calculate_stats used to get from the regex substitutions.
+
+        Args:
+            text (str): the text, already without comments
+
+        Returns:
+            dict: with the keys "commands" (list of latex commands),
+            "environments" (list of environment names),
+            "subfigures_in_figures" (list with the number of subfigures of each
+            figure), "references" (list like Stats.references_Counter),
+            "old_eq_count", "long_old_eqs" (the $ matches longer than 250
+            characters), "display_eq_count", "inline_eq_count",
+            "eq_env_count", "subeq_env_count" and "clean_text" (the text
+            without the removed commands, equations and subfigures).
+    """
+    commands = []
+    environments = []
+    subfigures_in_figures = []
+    references = []
+    long_old_eqs = []
+    old_eq_count = 0
+    display_eq_count = 0
+    inline_eq_count = 0
+    eq_env_count = 0
+    subeq_env_count = 0
+    clean_pieces = []
+
+    # Each pattern only matches after its own previous match, as in findall.
+    # `removed_until` plays the same role for everything that is removed.
+    env_next = 0
+    cite_next = 0
+    dollar_next = 0
+    inline_next = 0
+    display_next = 0
+    figure_next = 0
+    removed_until = 0
+    # Keeps the scan linear with unclosed delimiters, e.g. a stray $ or an
+    # unclosed \label{
+    match_at = LineMatcher(text).match
+    # Figures, subfigures and equation environments are taken from the tree
+    # of environments, parsed once, instead of matching their own patterns
+    environments_at = {
+        environment.start: environment
+        for environment in parse_environments(text).walk()
+    }
+
+    for token in token_regex.finditer(text):
+        position = token.start()
+        name = token.group()
+        removal = None
+        removal_end = None
+
+        if name == "$":
+            if position >= dollar_next:
+                match = match_at(dollar_eq_regex, position)
+                if match:
+                    old_eq_count += 1
+                    dollar_next = match.end()
+                    if match.end() - position > 250:
+                        long_old_eqs.append(match)
+                    if position >= removed_until:
+                        removal = match
+            # A stray $ inside an already removed part is not an equation
+            elif position >= removed_until:
+                removal = match_at(dollar_eq_regex, position)
+        elif name == "\\(":
+            match = None
+            if position >= inline_next or position >= removed_until:
+                match = match_at(inline_eq_regex, position)
+            if match and position >= inline_next:
+                inline_eq_count += 1
+                inline_next = match.end()
+            if position >= removed_until:
+                removal = match
+        elif name == "\\[":
+            match = None
+            if position >= display_next or position >= removed_until:
+                match = match_at(display_eq_regex, position)
+            if match and position >= display_next:
+                display_eq_count += 1
+                display_next = match.end()
+            if position >= removed_until:
+                removal = match
+        else:
+            commands.append(name)
+            if name == "\\begin":
+                env_match = None
+                if position >= env_next:
+                    env_match = match_at(env_name_regex, position)
+                if env_match:
+                    environments.append(env_match.group(1))
+                    env_next = env_match.end()
+                after = token.end()
+                if text.startswith("{equation", after):
+                    if text.startswith("}", after + 9) or text.startswith(
+                        "*}", after + 9
+                    ):
+                        eq_env_count += 1
+                elif text.startswith("{subequation", after):
+                    if text.startswith("}", after + 12) or text.startswith(
+                        "*}", after + 12
+                    ):
+                        subeq_env_count += 1
+                environment = environments_at.get(position)
+                if environment is not None and environment.closed:
+                    environment_name = environment.name.rstrip("*")
+                    if environment_name in ("equation", "subfigure"):
+                        if position >= removed_until:
+                            removal_end = environment.end
+                    elif environment_name == "figure" and position >= figure_next:
+                        figure_next = environment.end
+                        subfigures_in_figures.append(
+                            len(environment.find("subfigure"))
+                        )
+            elif name.startswith("\\cite"):
+                if position >= cite_next:
+                    match = match_at(cite_regex, position)
+                    references.append(match.group(1) or "")
+                    cite_next = match.end()
+                if position >= removed_until:
+                    removal = match_at(cite_regex, position)
+            elif name.startswith("\\ref") or name.startswith("\\autoref"):
+                if position >= removed_until:
+                    removal = match_at(ref_regex, position)
+            elif name in removed_commands and position >= removed_until:
+                removal = match_at(removed_commands[name], position)
+
+        if removal is not None:
+            removal_end = removal.end()
+        if removal_end is not None:
+            clean_pieces.append(text[removed_until:position])
+            removed_until = removal_end
+
+    clean_pieces.append(text[removed_until:])
+
+    return dict(
+        commands=commands,
+        environments=environments,
+        subfigures_in_figures=subfigures_in_figures,
+        references=references,
+        old_eq_count=old_eq_count,
+        long_old_eqs=long_old_eqs,
+        display_eq_count=display_eq_count,
+        inline_eq_count=inline_eq_count,
+        eq_env_count=eq_env_count,
+        subeq_env_count=subeq_env_count,
+        clean_text="".join(clean_pieces),
+    )
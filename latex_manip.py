@@ -1,12 +1,72 @@
 # File containing functions to create, modify, compile PDFs
 
+import csv
+import datetime
+import fnmatch
+import hashlib
+import json
 import os
+import queue
+import re
 import shutil
+import signal
 import subprocess
-import git
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from config import compiled_pdfs_path, thesis_path
-from repo_info import load_commit_list
+from typing import Dict, List, Optional, Tuple
+import git
+from config import (
+    compile_cache_path,
+    compiled_pdfs_path,
+    thesis_path,
+    worktrees_path,
+)
+from repo_info import load_commit_list, BlobReader
+from content_hash import content_hashes, link_artifact
+
+# Commits whose sources are changed before compiling, see compile_pdf_from_sha
+patched_commits = ("df17dbd",)
+
+# Files of the thesis repository that don't change the pdf, left out of
+# compile_hash
+compile_ignored_patterns = (
+    "README*",
+    "LICENSE*",
+    "*.md",
+    ".gitignore",
+    ".gitattributes",
+    ".github/*",
+    ".vscode/*",
+)
+
+# Changed when the pdfs of the same inputs would come out different, e.g. other
+# xelatex options, so the compile cache isn't used for them
+compile_cache_version = 1
+
+# Files xelatex writes in a pass and reads in the next one, see run_latex_passes
+auxiliary_suffixes = {".aux", ".toc", ".lof", ".lot", ".lol", ".out", ".idx"}
+
+# Seconds a single run of xelatex, makeindex or bibtex, and all the passes of a
+# commit, may take before they are killed, see run_latex_passes
+pass_timeout = 10 * 60
+commit_timeout = 30 * 60
+
+# Commits that failed to compile, or took too long, see compile_all_pdfs
+failures_file = Path(compile_cache_path) / "failures.jsonl"
+
+# Auxiliary files of compiled commits, one folder per sha, that start the
+# compilation of their descendants, see compile_all_pdfs(warm_start=True)
+auxiliary_store_path = Path(compile_cache_path) / "auxiliary"
+
+# Most generations looked back for a compiled ancestor to start from
+warm_start_depth = 50
+
+# Messages in the .log of packages asking for another pass
+rerun_regex = re.compile(
+    r"Rerun to get|Rerun LaTeX|Please rerun LaTeX|Label\(s\) may have changed|"
+    r"Table widths have changed"
+)
 
 
 def compile_pdf_from_sha(
@@ -18,17 +78,25 @@ def compile_pdf_from_sha(
     fix_includeonly: bool = True,
     verbose: bool = False,
     overwrite_pdf: bool = False,
-) -> None:
+    max_passes: int = 4,
+    pass_timeout: float = pass_timeout,
+    commit_timeout: float = commit_timeout,
+    seed_from: str = None,
+    save_auxiliary: bool = False,
+) -> Optional[dict]:
     r"""Compiles the pdf using xelatex, targetting the file in `mainfile_name`,
     then copies the pdf to the path specified in `output_path`. Requires a
     git.Repo instance pointing to the repository. Can remove lines that contain
     "includeonly", so it compiles the full text. Verbose can be used to show, or
-    not, the compilation output.
+    not, the compilation output. The working directory isn't changed, so
+    several commits can be compiled at the same time, each in its own
+    checkout (see compile_all_pdfs).
 
         Args:
             sha (str): the sha hash that git can use to checkout
             output_path (str): where the compiled pdf will be stored
-            repo (git.Repo): the git repo instance
+            repo (git.Repo): the git repo instance, of the checkout in
+                `texfile_location`
             texfile_location (str): the location of the .tex files
             mainfile_name (str): the name of the main file, typically main.tex
             fix_includeonly (bool, optional): Removes any lines that contain
@@ -36,37 +104,47 @@ def compile_pdf_from_sha(
             verbose (bool, optional): If set to true, shows all the output of
                 the programs used. Defaults to False.
             overwrite_pdf (bool): Overwrites any already compiled pdf
-    """
-    repo.git.checkout(sha, force=True)
-    xelatex_command = (
-        "xelatex",
-        "-shell-escape",
-        "-interaction=nonstopmode",
-        mainfile_name,
-    )
-    makeindex_command = ("makeindex", mainfile_name)
-    bibtex_command = ("bibtex", mainfile_name[:-4])
+            max_passes (int, optional): most xelatex passes, see
+                run_latex_passes. Defaults to 4.
+            pass_timeout (float, optional): seconds each program may run,
+                see run_latex_passes.
+            commit_timeout (float, optional): seconds all the passes may
+                take, see run_latex_passes.
+            seed_from (str, optional): sha of a compiled commit, usually an
+                ancestor, whose auxiliary files (see save_auxiliary_files) the
+                compilation starts from, instead of the ones left in the
+                checkout. If the document doesn't become stable or no pdf is
+                made, it is compiled again from scratch. Defaults to None.
+            save_auxiliary (bool, optional): keeps the auxiliary files, to
+                start the compilation of other commits. Defaults to False.
 
+        Returns:
+            dict: how the pdf was compiled, with the keys passes, seeded_from
+            (the sha, or None) and fell_back (whether the seed was discarded).
+            None when the pdf already existed.
+
+        Raises:
+            TimeoutError: the compilation took too long, and was killed
+            RuntimeError: xelatex didn't make a pdf
+    """
     # Create folder if not exists
     os.makedirs(output_path, exist_ok=True)
+    pdf = Path(output_path) / (sha + ".pdf")
     # Check if there's already a pdf file there
-    if (not overwrite_pdf) and os.path.isfile(Path(output_path) / (sha + ".pdf")):
+    if (not overwrite_pdf) and pdf.is_file():
         print(f"Already compiled {sha}, skipping")
-        return
-
-    # It's easier to change dirs because of the latex commands, copy the pdf,
-    # then change back
-    original_dir = os.getcwd()
-    os.chdir(texfile_location)
+        return None
 
+    repo.git.checkout(sha, force=True)
+    source = Path(texfile_location)
     if fix_includeonly:
-        maintex = open(mainfile_name, "r").readlines()
+        maintex = open(source / mainfile_name, "r").readlines()
         # Very crude
         for i, line in enumerate(maintex):
             if "includeonly" in line:
                 # maintex.replace("includeonly", "")
                 maintex[i] = ""
-        with open(mainfile_name, "w") as fhand:
+        with open(source / mainfile_name, "w") as fhand:
             fhand.write(
                 "".join(maintex)
             )  # not "\n".join... Because written in Windows?
@@ -76,49 +154,656 @@ def compile_pdf_from_sha(
     # command was \toprule. Even with the newline between them, xelatex was
     # considering it to be \toprule[NaSal], and accusing NaSal of not being a
     # number, freezing compilation.
-    if sha.startswith("df17dbd"):
-        problematic_text = open("aditivos.tex", "r").read()
-        import re
-
+    if sha.startswith(patched_commits):
+        problematic_text = open(source / "aditivos.tex", "r").read()
         problematic_text = re.sub(
             r"\\toprule([\s%]+?)\[NaSal\]",
             r"\\toprule\1NaSal",
             problematic_text,
         )
-        with open("aditivos.tex", "w") as fhand:
+        with open(source / "aditivos.tex", "w") as fhand:
             fhand.write(problematic_text)
 
-    print("\tCompilation 1", flush=True)
-    _ = subprocess.run(xelatex_command, capture_output=not verbose)
-    print("\tIndex", flush=True)
-    _ = subprocess.run(makeindex_command, capture_output=not verbose)
-    print("\tReferences", flush=True)
-    _ = subprocess.run(bibtex_command, capture_output=not verbose)
-    print("\tCompilation 2", flush=True)
-    _ = subprocess.run(xelatex_command, capture_output=not verbose)
-    print("\tCompilation 3", flush=True)
-    _ = subprocess.run(xelatex_command, capture_output=not verbose)
-    print("\tCompilation 4", flush=True)
-    _ = subprocess.run(xelatex_command, capture_output=not verbose)
-    print(flush=True)
-    print("\tCompilation done", flush=True)
-
-    shutil.copy(
-        mainfile_name[:-4] + ".pdf",
-        Path(original_dir) / Path(output_path) / f"{sha}.pdf",
+    # So the pdf of the commit compiled before in this checkout isn't taken
+    # for this one if xelatex fails
+    compiled_pdf = source / (mainfile_name[:-4] + ".pdf")
+    compiled_pdf.unlink(missing_ok=True)
+    if seed_from is not None:
+        print(f"\t{sha[:7]}: Starting from the files of {seed_from[:7]}", flush=True)
+        seed_auxiliary_files(source, seed_from, mainfile_name)
+    started = time.monotonic()
+    passes, stable = run_latex_passes(
+        source,
+        mainfile_name,
+        sha[:7],
+        verbose=verbose,
+        max_passes=max_passes,
+        pass_timeout=pass_timeout,
+        commit_timeout=commit_timeout,
+    )
+    fell_back = seed_from is not None and not (stable and compiled_pdf.is_file())
+    if fell_back:
+        print(
+            f"\t{sha[:7]}: Didn't work starting from {seed_from[:7]}, compiling "
+            "from scratch",
+            flush=True,
+        )
+        clean_auxiliary_files(source, mainfile_name)
+        compiled_pdf.unlink(missing_ok=True)
+        # Only what's left of commit_timeout, not all of it again
+        if commit_timeout is not None:
+            commit_timeout -= time.monotonic() - started
+        passes, stable = run_latex_passes(
+            source,
+            mainfile_name,
+            sha[:7],
+            verbose=verbose,
+            max_passes=max_passes,
+            pass_timeout=pass_timeout,
+            commit_timeout=commit_timeout,
+        )
+    print(f"\t{sha[:7]}: Compilation done, {passes} passes", flush=True)
+
+    # Copied under another name first, so an interrupted copy isn't taken for
+    # a compiled pdf
+    if not compiled_pdf.is_file():
+        raise RuntimeError(f"xelatex didn't make a pdf of {sha}")
+    partial_pdf = pdf.with_suffix(".pdf.partial")
+    shutil.copy(compiled_pdf, partial_pdf)
+    os.replace(partial_pdf, pdf)
+
+    build = dict(
+        passes=passes, seeded_from=None if fell_back else seed_from, fell_back=fell_back
+    )
+    # Files of a document that never became stable aren't a good start
+    if save_auxiliary and stable:
+        save_auxiliary_files(source, sha, build, mainfile_name)
+    return build
+
+
+def _file_digest(path: Path) -> str:
+    return hashlib.sha1(path.read_bytes()).hexdigest() if path.is_file() else ""
+
+
+def _auxiliary_state(source: Path) -> dict:
+    """Digests of the files xelatex writes and reads back in the next pass, of
+    the main file and of the \\include'd ones"""
+    return {
+        str(path): _file_digest(path)
+        for path in source.rglob("*")
+        if path.suffix in auxiliary_suffixes
+    }
+
+
+def _bibtex_inputs(source: Path) -> str:
+    """Digest of what bibtex reads: the \\citation, \\bibdata and \\bibstyle
+    lines of all the .aux files, and the .bib files named by \\bibdata"""
+    digest = hashlib.sha1()
+    bib_files = []
+    for aux in sorted(source.rglob("*.aux")):
+        for line in aux.read_text("utf8", errors="replace").splitlines():
+            if line.startswith(("\\citation", "\\bibdata", "\\bibstyle")):
+                digest.update(line.encode("utf8"))
+            if line.startswith("\\bibdata{"):
+                bib_files += line[len("\\bibdata{") : -1].split(",")
+    for name in bib_files:
+        name = name if name.endswith(".bib") else name + ".bib"
+        digest.update(_file_digest(source / name).encode())
+    return digest.hexdigest()
+
+
+def run_with_timeout(
+    command: tuple, cwd: Path, verbose: bool = False, timeout: float = None
+) -> int:
+    """Runs a program, killing it and every process it started (e.g. the
+    ones of -shell-escape) when it takes longer than `timeout` seconds.
+    Without verbose, its output is discarded, xelatex writes it to the .log.
+
+        Returns:
+            int: the return code of the program
+
+        Raises:
+            TimeoutError: the program was killed
+    """
+    output = None if verbose else subprocess.DEVNULL
+    if os.name == "nt":
+        process = subprocess.Popen(command, cwd=cwd, stdout=output, stderr=output)
+    else:
+        # In its own process group, so the whole group can be killed
+        process = subprocess.Popen(
+            command, cwd=cwd, stdout=output, stderr=output, start_new_session=True
+        )
+    try:
+        return process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill_process_tree(process)
+        raise TimeoutError(
+            f"{command[0]} took more than {timeout:.0f} seconds, killed"
+        ) from None
+    except BaseException:
+        # e.g. Ctrl+C, no xelatex is left running
+        _kill_process_tree(process)
+        raise
+
+
+def _kill_process_tree(process: subprocess.Popen) -> None:
+    if os.name == "nt":
+        subprocess.run(
+            ("taskkill", "/F", "/T", "/PID", str(process.pid)), capture_output=True
+        )
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    process.wait()
+
+
+def clean_auxiliary_files(source: Path, mainfile_name: str = "main.tex") -> None:
+    """Removes the files xelatex, makeindex and bibtex write between passes,
+    e.g. after a failed or killed compilation, which can leave them broken
+    for the next commit compiled in the same checkout"""
+    stem = mainfile_name[:-4]
+    for path in source.rglob("*"):
+        if path.suffix in auxiliary_suffixes and path.is_file():
+            path.unlink()
+    for suffix in (".bbl", ".ind", ".passes.json"):
+        (source / (stem + suffix)).unlink(missing_ok=True)
+
+
+def _warm_start_files(source: Path, mainfile_name: str = "main.tex") -> List[Path]:
+    """The files xelatex, makeindex and bibtex wrote, which the next
+    compilation reads"""
+    stem = mainfile_name[:-4]
+    files = [
+        path
+        for path in source.rglob("*")
+        if path.suffix in auxiliary_suffixes and path.is_file()
+    ]
+    for suffix in (".bbl", ".ind", ".passes.json"):
+        if (source / (stem + suffix)).is_file():
+            files.append(source / (stem + suffix))
+    return files
+
+
+def save_auxiliary_files(
+    source: Path,
+    sha: str,
+    build: dict,
+    mainfile_name: str = "main.tex",
+    path: Path = auxiliary_store_path,
+) -> None:
+    """Copies the auxiliary files of a compiled commit to path/sha, with a
+    build.json saying how it was compiled (see compile_pdf_from_sha). Written
+    to another folder first, so a folder with a build.json is complete."""
+    destination = Path(path) / sha
+    partial = Path(path) / (sha + ".partial")
+    shutil.rmtree(partial, ignore_errors=True)
+    for file in _warm_start_files(source, mainfile_name):
+        copy = partial / file.relative_to(source)
+        os.makedirs(copy.parent, exist_ok=True)
+        shutil.copyfile(file, copy)
+    os.makedirs(partial, exist_ok=True)
+    (partial / "build.json").write_text(json.dumps(dict(sha=sha, **build)))
+    shutil.rmtree(destination, ignore_errors=True)
+    os.replace(partial, destination)
+
+
+def seed_auxiliary_files(
+    source: Path,
+    seed_sha: str,
+    mainfile_name: str = "main.tex",
+    path: Path = auxiliary_store_path,
+) -> None:
+    """Replaces the auxiliary files in the checkout with the ones saved for
+    another commit, see save_auxiliary_files"""
+    clean_auxiliary_files(source, mainfile_name)
+    seed = Path(path) / seed_sha
+    for file in seed.rglob("*"):
+        if file.is_file() and file.name != "build.json":
+            copy = source / file.relative_to(seed)
+            os.makedirs(copy.parent, exist_ok=True)
+            shutil.copyfile(file, copy)
+
+
+def nearest_compiled_ancestor(
+    sha: str,
+    parents: Dict[str, List[str]],
+    depth: int = warm_start_depth,
+    path: Path = auxiliary_store_path,
+) -> Optional[str]:
+    """Finds the closest ancestor of a commit with saved auxiliary files,
+    going back one generation at a time, first parents first.
+
+        Args:
+            sha (str): the commit
+            parents (Dict[str, List[str]]): sha -> parent shas, from the
+            commit index
+            depth (int, optional): most generations looked back. Defaults to
+            warm_start_depth.
+            path (Path, optional): Defaults to auxiliary_store_path.
+
+        Returns:
+            Optional[str]: the sha of the ancestor, None if there isn't one
+    """
+    generation = parents.get(sha, [])
+    seen = set(generation)
+    for _ in range(depth):
+        for ancestor in generation:
+            if (Path(path) / ancestor / "build.json").is_file():
+                return ancestor
+        next_generation = []
+        for ancestor in generation:
+            for parent in parents.get(ancestor, []):
+                if parent not in seen:
+                    seen.add(parent)
+                    next_generation.append(parent)
+        if not next_generation:
+            break
+        generation = next_generation
+    return None
+
+
+def run_latex_passes(
+    source: Path,
+    mainfile_name: str = "main.tex",
+    label: str = "",
+    verbose: bool = False,
+    max_passes: int = 4,
+    pass_timeout: float = pass_timeout,
+    commit_timeout: float = commit_timeout,
+) -> Tuple[int, bool]:
+    """Runs xelatex until the document is stable, instead of a fixed number of
+    times, with makeindex and bibtex between the passes only when what they
+    read changed. The document is stable when xelatex doesn't ask for a rerun
+    in the .log and the .aux, .toc, etc. are the same as before the pass. What
+    makeindex and bibtex last read is kept in a file in the checkout, so when
+    the checkout is reused for another commit with the same citations or
+    index, they don't run at all.
+
+        Args:
+            source (Path): folder of the main file
+            mainfile_name (str, optional): Defaults to "main.tex".
+            label (str, optional): printed before the name of each step, e.g.
+            the short sha. Defaults to "".
+            verbose (bool, optional): shows the output of the programs.
+            Defaults to False.
+            max_passes (int, optional): most xelatex passes, for documents
+            that never become stable. Defaults to 4, as many as were always
+            run before.
+            pass_timeout (float, optional): seconds each run of xelatex,
+            makeindex or bibtex may take. None waits forever. Defaults to
+            pass_timeout.
+            commit_timeout (float, optional): seconds all of them together
+            may take. None waits forever. Defaults to commit_timeout.
+
+        Returns:
+            int: the number of xelatex passes
+            bool: whether the document became stable before max_passes
+
+        Raises:
+            TimeoutError: a program was killed for taking too long
+    """
+    stem = mainfile_name[:-4]
+    xelatex_command = (
+        "xelatex",
+        "-shell-escape",
+        "-interaction=nonstopmode",
+        mainfile_name,
+    )
+    # Each tool, with the digest of what it reads and the file it writes
+    tools = (
+        ("makeindex", lambda: _file_digest(source / (stem + ".idx")), ".ind"),
+        ("bibtex", lambda: _bibtex_inputs(source), ".bbl"),
+    )
+    commands = dict(
+        makeindex=("makeindex", stem + ".idx"), bibtex=("bibtex", stem)
+    )
+    record_file = source / (stem + ".passes.json")
+    try:
+        last_inputs = json.loads(record_file.read_text())
+    except (OSError, ValueError):
+        last_inputs = {}
+
+    deadline = None if commit_timeout is None else time.monotonic() + commit_timeout
+
+    def run(command: tuple) -> None:
+        timeout = pass_timeout
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(
+                    f"Compilation took more than {commit_timeout:.0f} seconds"
+                )
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        run_with_timeout(command, source, verbose=verbose, timeout=timeout)
+
+    state = _auxiliary_state(source)
+    passes = 0
+    while passes < max_passes:
+        passes += 1
+        print(f"\t{label}: Compilation {passes}", flush=True)
+        run(xelatex_command)
+        log_file = source / (stem + ".log")
+        log = log_file.read_text("utf8", errors="replace") if log_file.is_file() else ""
+        previous_state, state = state, _auxiliary_state(source)
+
+        ran_tool = False
+        for tool, inputs, output in tools:
+            digest = inputs()
+            if digest == last_inputs.get(tool) and (source / (stem + output)).is_file():
+                continue
+            if tool == "makeindex" and not (source / (stem + ".idx")).is_file():
+                continue
+            if tool == "bibtex" and not (source / (stem + ".aux")).is_file():
+                continue
+            print(f"\t{label}: {tool}", flush=True)
+            run(commands[tool])
+            last_inputs[tool] = digest
+            ran_tool = True
+        record_file.write_text(json.dumps(last_inputs))
+
+        if not ran_tool and state == previous_state and not rerun_regex.search(log):
+            return passes, True
+    return passes, False
+
+
+def compile_hash(reader: BlobReader, sha: str) -> str:
+    """Content hash of everything that changes the pdf compile_pdf_from_sha
+    makes: every file of the commit, in subfolders too, except the ones in
+    compile_ignored_patterns, whether the sources are patched before compiling
+    and compile_cache_version. Also used for the images made from the pdfs
+    (see collate_pages)."""
+    digest = hashlib.sha1(f"version {compile_cache_version}\n".encode())
+    for path, blob_sha in reader.walk_tree(sha):
+        if any(fnmatch.fnmatch(path, pattern) for pattern in compile_ignored_patterns):
+            continue
+        digest.update(f"{path}\0{blob_sha}\n".encode("utf8"))
+    if sha.startswith(patched_commits):
+        digest.update(b"patched\n")
+    return digest.hexdigest()
+
+
+def cached_pdf(key: str) -> Path:
+    """Where the pdf of a compile_hash is kept in the compile cache"""
+    return Path(compile_cache_path) / (key + ".pdf")
+
+
+def save_cache_statistics(statistics: dict) -> None:
+    """Prints the hits and misses of the compile cache in a run, and adds them
+    to compile_cache_path/statistics.csv, one line per run"""
+    looked_up = statistics["hits"] + statistics["misses"]
+    statistics = dict(
+        date=datetime.datetime.now().isoformat(timespec="seconds"),
+        **statistics,
+        hit_rate=round(statistics["hits"] / looked_up, 4) if looked_up else "",
     )
+    print(
+        "Compile cache: {hits} hits, {misses} misses, {already_compiled} already "
+        "compiled, {failed} failed, {skipped_failed} skipped for failing "
+        "before, {warm_starts} warm starts, {cold_fallbacks} fell back to "
+        "compiling from scratch".format(**statistics),
+        flush=True,
+    )
+    filename = Path(compile_cache_path) / "statistics.csv"
+    new_file = not filename.is_file()
+    os.makedirs(compile_cache_path, exist_ok=True)
+    with open(filename, "a", newline="") as fhand:
+        writer = csv.DictWriter(fhand, fieldnames=list(statistics))
+        if new_file:
+            writer.writeheader()
+        writer.writerow(statistics)
+
+
+def load_failures(filename: Path = failures_file) -> Dict[str, dict]:
+    """Reads the failure ledger, where each compilation that failed or timed
+    out, and each later success of one of those commits, is a JSON line.
+
+        Returns:
+            Dict[str, dict]: sha -> its last line, for the commits whose last
+            compilation failed. Each has the keys sha, key (see compile_hash),
+            date, status ("failed", "timeout" or "no pdf"), error and log_tail.
+    """
+    failures = {}
+    try:
+        fhand = open(filename, "r", encoding="utf8")
+    except FileNotFoundError:
+        return failures
+    with fhand:
+        for line in fhand:
+            if not line.endswith("\n"):
+                break
+            entry = json.loads(line)
+            if entry["status"] == "compiled":
+                failures.pop(entry["sha"], None)
+            else:
+                failures[entry["sha"]] = entry
+    return failures
+
+
+def record_compilation(entry: dict, filename: Path = failures_file) -> None:
+    """Adds a line to the failure ledger, see load_failures"""
+    os.makedirs(Path(filename).parent, exist_ok=True)
+    entry = dict(date=datetime.datetime.now().isoformat(timespec="seconds"), **entry)
+    with open(filename, "a", encoding="utf8") as fhand:
+        fhand.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
 
-    os.chdir(original_dir)
+def log_tail(
+    source: Path, mainfile_name: str = "main.tex", since: float = 0, lines: int = 30
+) -> str:
+    """The last lines of the xelatex .log, if it was written after `since`
+    (a time.time()), so the log of another commit isn't taken for this one"""
+    log_file = Path(source) / (mainfile_name[:-4] + ".log")
+    if not log_file.is_file() or log_file.stat().st_mtime < since:
+        return ""
+    log = log_file.read_text("utf8", errors="replace").splitlines()
+    return "\n".join(log[-lines:])
 
 
-def compile_all_pdfs() -> None:
-    """Compiles all pdfs possible."""
+def create_worktrees(
+    number: int, repo_path: str = thesis_path, path: str = worktrees_path
+) -> List[Path]:
+    """Makes sure there are `number` git worktrees of the thesis repository,
+    so each compilation process has its own checkout. They are kept between
+    runs, so next time they only need to check out the differences.
+
+        Args:
+            number (int): how many worktrees
+            repo_path (str, optional): Defaults to thesis_path.
+            path (str, optional): where the worktrees are. Defaults to
+            worktrees_path.
+
+        Returns:
+            List[Path]: the absolute paths of the worktrees
+    """
+    # Forgets worktrees whose folders were deleted
+    subprocess.run(["git", "worktree", "prune"], cwd=repo_path, check=True)
+    worktrees = []
+    for i in range(number):
+        worktree = (Path(path) / f"worker-{i}").absolute()
+        if not (worktree / ".git").exists():
+            subprocess.run(
+                ["git", "worktree", "add", "--detach", str(worktree)],
+                cwd=repo_path,
+                check=True,
+                capture_output=True,
+            )
+        worktrees.append(worktree)
+    return worktrees
+
+
+def compile_all_pdfs(
+    jobs: int = 1,
+    verbose: bool = False,
+    retry_failed: bool = False,
+    pass_timeout: float = pass_timeout,
+    commit_timeout: float = commit_timeout,
+    warm_start: bool = False,
+) -> None:
+    """Compiles all pdfs possible. The pdfs are kept in a cache by the hash of
+    their inputs (see compile_hash), so a commit with the same inputs as one
+    compiled before, in this run or another, even from a rewritten history,
+    gets a link to its pdf instead. The hits and misses of the cache are saved
+    (see save_cache_statistics).
+
+    A compilation that fails or takes too long is killed and added to the
+    failure ledger (see load_failures) with the end of its .log, and the next
+    commit is compiled. Later runs skip the commits in the ledger, and the
+    ones with the same inputs, unless `retry_failed`.
+
+    The commits are compiled from the oldest to the newest. With `warm_start`,
+    each starts from the auxiliary files (.aux, .bbl, .ind, etc.) of its
+    nearest compiled ancestor (see nearest_compiled_ancestor), so the
+    references and the bibliography are usually right after a single pass,
+    instead of from whatever the last commit compiled in the checkout left.
+
+        Args:
+            jobs (int, optional): number of commits compiled at the same time.
+            With more than one, each is compiled in its own git worktree (see
+            create_worktrees), and the thesis repository itself isn't checked
+            out. Defaults to 1.
+            verbose (bool, optional): shows the output of the LaTeX programs,
+            see compile_pdf_from_sha. Defaults to False.
+            retry_failed (bool, optional): compiles the commits of the failure
+            ledger again. Defaults to False.
+            pass_timeout (float, optional): seconds each run of xelatex,
+            makeindex or bibtex may take, see run_latex_passes.
+            commit_timeout (float, optional): seconds the passes of a commit
+            may take, see run_latex_passes.
+            warm_start (bool, optional): starts each compilation from the
+            files of a compiled ancestor, and saves the files of each commit
+            compiled, in auxiliary_store_path. Defaults to False.
+    """
 
     commits = load_commit_list()
-    repo = git.Repo(thesis_path)
-    for i, commit in enumerate(commits):
+    # From every commit, not only the sampled ones, so the nearest ancestor is
+    # found through the commits left out
+    parents = {
+        commit["sha"]: commit["parents"] for commit in load_commit_list(sampling="all")
+    }
+    hashes = content_hashes([commit["sha"] for commit in commits], compile_hash)
+    failures = load_failures()
+    failed_keys = {entry["key"] for entry in failures.values()} - {None}
+    statistics = dict(
+        commits=len(commits),
+        already_compiled=0,
+        hits=0,
+        misses=0,
+        failed=0,
+        skipped_failed=0,
+        warm_starts=0,
+        cold_fallbacks=0,
+    )
+    os.makedirs(compiled_pdfs_path, exist_ok=True)
+    # Pdfs compiled before the cache existed are added to it
+    for sha, key in hashes.items():
+        pdf = Path(compiled_pdfs_path) / (sha + ".pdf")
+        if key is not None and pdf.is_file() and not cached_pdf(key).is_file():
+            os.makedirs(compile_cache_path, exist_ok=True)
+            link_artifact(pdf, cached_pdf(key))
+
+    # Only the first commit of each hash missing from the cache is compiled,
+    # the others wait for it and get a link
+    to_compile = []
+    waiting = {}
+    # Oldest first, so the ancestors are compiled before their descendants
+    for commit in reversed(commits):
+        sha = commit["sha"]
+        pdf = Path(compiled_pdfs_path) / (sha + ".pdf")
+        key = hashes[sha]
+        if pdf.is_file():
+            print(f"Already compiled {sha}, skipping")
+            statistics["already_compiled"] += 1
+        elif key is not None and cached_pdf(key).is_file():
+            print(f"Same inputs as a compiled pdf, linking {sha}", flush=True)
+            link_artifact(cached_pdf(key), pdf)
+            statistics["hits"] += 1
+        elif not retry_failed and (sha in failures or key in failed_keys):
+            print(f"Failed to compile before, skipping {sha}")
+            statistics["skipped_failed"] += 1
+        elif key in waiting:
+            waiting[key].append(pdf)
+        else:
+            to_compile.append(commit)
+            if key is not None:
+                waiting[key] = []
+    if statistics["skipped_failed"]:
         print(
-            f'Compilation {i+1} of {len(commits)}: {commit["message"]}',
-            flush=True,
+            f'Skipped {statistics["skipped_failed"]} commits that failed before, '
+            f"listed in {failures_file}. Use --retry-failed to compile them again."
         )
-        compile_pdf_from_sha(commit["sha"], repo, verbose=False)
+
+    # Each compilation takes a free checkout, and gives it back when done
+    checkouts = queue.Queue()
+    for checkout in [thesis_path] if jobs == 1 else create_worktrees(jobs):
+        checkouts.put(checkout)
+
+    def compile_in_checkout(commit: dict) -> dict:
+        """Returns the failure ledger entry of the commit"""
+        checkout = checkouts.get()
+        started = time.time()
+        try:
+            print(f'Compiling {commit["sha"]}: {commit["message"]}', flush=True)
+            seed = None
+            if warm_start:
+                seed = nearest_compiled_ancestor(commit["sha"], parents)
+                # Without an ancestor, from scratch, not from the files of
+                # whatever commit was compiled before in this checkout
+                if seed is None:
+                    clean_auxiliary_files(Path(checkout))
+            build = compile_pdf_from_sha(
+                commit["sha"],
+                git.Repo(checkout),
+                texfile_location=checkout,
+                verbose=verbose,
+                pass_timeout=pass_timeout,
+                commit_timeout=commit_timeout,
+                seed_from=seed,
+                save_auxiliary=warm_start,
+            )
+            return dict(status="compiled", **(build or {}))
+        except Exception as error:
+            status = "timeout" if isinstance(error, TimeoutError) else "failed"
+            tail = log_tail(checkout, since=started)
+            clean_auxiliary_files(Path(checkout))
+            return dict(status=status, error=str(error), log_tail=tail)
+        finally:
+            checkouts.put(checkout)
+
+    try:
+        with ThreadPoolExecutor(jobs) as executor:
+            futures = {
+                executor.submit(compile_in_checkout, commit): commit
+                for commit in to_compile
+            }
+            for i, future in enumerate(as_completed(futures)):
+                sha = futures[future]["sha"]
+                pdf = Path(compiled_pdfs_path) / (sha + ".pdf")
+                key = hashes[sha]
+                same_inputs = waiting.get(key, [])
+                entry = dict(sha=sha, key=key, **future.result())
+                statistics["misses"] += 1
+                if entry["status"] == "compiled" and not pdf.is_file():
+                    entry["status"] = "no pdf"
+                    entry["error"] = "xelatex didn't make a pdf"
+                if entry["status"] != "compiled":
+                    print(f'Compilation of {sha} failed: {entry["error"]}')
+                    statistics["failed"] += 1 + len(same_inputs)
+                    record_compilation(entry)
+                else:
+                    if key is not None:
+                        os.makedirs(compile_cache_path, exist_ok=True)
+                        link_artifact(pdf, cached_pdf(key))
+                    for same_inputs_pdf in same_inputs:
+                        link_artifact(pdf, same_inputs_pdf)
+                    statistics["hits"] += len(same_inputs)
+                    statistics["warm_starts"] += entry.get("seeded_from") is not None
+                    statistics["cold_fallbacks"] += entry.get("fell_back", False)
+                    if sha in failures:
+                        record_compilation(dict(sha=sha, key=key, status="compiled"))
+                print(
+                    f"Compilation {i+1} of {len(futures)} finished: {sha}", flush=True
+                )
+    finally:
+        save_cache_statistics(statistics)
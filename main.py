@@ -2,16 +2,19 @@
 # encoding=utf8
 # This file contains a sequence that should be followed in order to compile all the frames of the video
 # To join the frames into a movie and add some music, one must use a video editor, like DaVinci Resolve
-from collate_pages import dismember_all_pdfs, collate_all, compress_all_images
-from create_figure import create_all_graphs
-from repo_info import create_commit_list
-from text_stats import create_all_stats
-from latex_manip import compile_all_pdfs
+# Each stage is only imported when chosen, so the menu shows up right away and
+# the heavy libraries (matplotlib, wordcloud, nltk, pandas) are only loaded by
+# the stages that use them. Run with --offline to never download nltk data, and
+# with --sampling to use only some of the commits (see commit_sampling).
+import argparse
+import os
 import config
+import nlp_resources
+from commit_sampling import parse_policy, sampling_variable
 from pathlib import Path
 
 
-def main():
+def main(jobs: int = 1, retry_failed: bool = False, warm_start: bool = False):
     options = """
     Choose an option
     
@@ -33,19 +36,35 @@ def main():
             break
         else:
             if (choice == "1") or (choice == "8"):
+                from repo_info import create_commit_list
+
                 create_commit_list()
                 print("\t Done creating commit list")
             if (choice == "2") or (choice == "8"):
-                create_all_stats()
+                from text_stats import create_all_stats
+
+                create_all_stats(jobs=jobs)
             if (choice == "3") or (choice == "8"):
-                compile_all_pdfs()
+                from latex_manip import compile_all_pdfs
+
+                compile_all_pdfs(
+                    jobs=jobs, retry_failed=retry_failed, warm_start=warm_start
+                )
             if (choice == "4") or (choice == "8"):
+                from collate_pages import dismember_all_pdfs
+
                 dismember_all_pdfs()
             if (choice == "5") or (choice == "8"):
+                from collate_pages import collate_all
+
                 collate_all()
             if (choice == "6") or (choice == "8"):
+                from collate_pages import compress_all_images
+
                 compress_all_images()
             if (choice == "7") or (choice == "8"):
+                from create_figure import create_all_graphs
+
                 create_all_graphs()
 
 
@@ -65,4 +84,47 @@ def create_directories() -> None:
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description="Creates the frames of the video of the thesis evolution"
+    )
+    parser.add_argument(
+        "--offline", action="store_true", help="never download the nltk data"
+    )
+    parser.add_argument(
+        "--sampling",
+        help="commits used by every stage, e.g. bucket:1d, words:200 or "
+        "frames:300, see commit_sampling. Defaults to every commit.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="commits processed at the same time when calculating the stats and "
+        "compiling the pdfs",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="compiles again the commits that failed or timed out before, see "
+        "latex_manip.load_failures",
+    )
+    parser.add_argument(
+        "--warm-start",
+        action="store_true",
+        help="starts each compilation from the .aux, .bbl, etc. of a compiled "
+        "ancestor, see latex_manip.compile_all_pdfs",
+    )
+    arguments = parser.parse_args()
+    # In the environment, so the worker processes see them too
+    if arguments.offline:
+        os.environ[nlp_resources.offline_variable] = "1"
+    if arguments.sampling:
+        os.environ[sampling_variable] = arguments.sampling
+    # Checked now, instead of when the first stage loads the commits
+    policy = os.environ.get(sampling_variable, "").strip()
+    if policy not in ("", "all"):
+        try:
+            parse_policy(policy)
+        except ValueError as error:
+            parser.error(str(error))
+    main(arguments.jobs, arguments.retry_failed, arguments.warm_start)
@@ -0,0 +1,82 @@
+# Loads nltk and the data it needs (stopwords, stemmers) only when a Stats is
+# first calculated, once per process. Missing data is downloaded, unless the
+# offline mode is on (environment variable EVOLUTION_OFFLINE=1, or
+# `python main.py --offline`), where it fails right away saying how to install
+# it, instead of waiting for the network.
+
+import os
+from functools import lru_cache
+
+offline_variable = "EVOLUTION_OFFLINE"
+
+# nltk package -> path of its data, as used by nltk.data.find
+nltk_data_paths = {
+    "stopwords": "corpora/stopwords",
+}
+
+
+def is_offline() -> bool:
+    """Whether downloads are forbidden. Read from the environment each time,
+    so worker processes see the same value as the main one."""
+    return os.environ.get(offline_variable, "").lower() not in ("", "0", "false", "no")
+
+
+def _import_nltk():
+    try:
+        import nltk
+    except ModuleNotFoundError:
+        raise ModuleNotFoundError(
+            "nltk is needed to calculate the stats, install it with "
+            "`pip install nltk`"
+        ) from None
+    return nltk
+
+
+def require(package: str) -> None:
+    """Makes sure the data of an nltk package is installed, downloading it
+    if needed.
+
+        Args:
+            package (str): e.g. "stopwords", see nltk_data_paths
+
+        Raises:
+            LookupError: the data is missing and can't be downloaded, either
+            because of the offline mode or because the download failed.
+    """
+    nltk = _import_nltk()
+    try:
+        nltk.data.find(nltk_data_paths[package])
+        return
+    except LookupError:
+        pass
+    install = f"`python -m nltk.downloader {package}`"
+    if is_offline():
+        raise LookupError(
+            f"The nltk data '{package}' is not installed, and the offline mode "
+            f"is on ({offline_variable}). Install it with {install} on a machine "
+            "with internet access, and copy the nltk_data folder."
+        )
+    print(f"Downloading the nltk data '{package}'")
+    if not nltk.download(package, quiet=True):
+        raise LookupError(
+            f"Could not download the nltk data '{package}', install it with "
+            f"{install}."
+        )
+
+
+@lru_cache(maxsize=None)
+def stopwords() -> frozenset:
+    """The Portuguese stopwords, loaded from disk only once"""
+    require("stopwords")
+    from nltk.corpus import stopwords as stopwords_corpus
+
+    return frozenset(stopwords_corpus.words("portuguese"))
+
+
+@lru_cache(maxsize=None)
+def snowball_stemmer():
+    """The Portuguese SnowballStemmer, which doesn't need any data"""
+    _import_nltk()
+    from nltk.stem.snowball import SnowballStemmer
+
+    return SnowballStemmer("portuguese")
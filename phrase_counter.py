@@ -0,0 +1,75 @@
+# Counts terms of more than one word (like "micelas gigantes") and words that
+# should be shown with another spelling (like "nasal", which is "NaSal") as
+# single words. Used by Stats.calculate_stats on the tokens, so the word
+# Counters, and everything calculated from them, already have the terms.
+
+import hashlib
+import json
+from typing import Dict, List
+
+# Lowercase words of the term, separated by spaces -> how it is shown
+phrases = {
+    "nasal": "NaSal",
+    "micelas gigantes": "micelas gigantes",
+}
+
+
+class PhraseCounter:
+    """Finds all terms of a dictionary in a list of tokens at once. The terms
+    are kept in a trie of words, so each token is only compared with the terms
+    that start with it, and the number of terms doesn't change the time taken.
+    When terms overlap, the longest one starting first is used, e.g.
+    "micelas gigantes" and not "micelas"."""
+
+    def __init__(self, phrases: Dict[str, str] = phrases):
+        """
+        Args:
+            phrases (Dict[str, str], optional): the lowercase words of each
+            term, separated by spaces, and how the term is shown in the
+            Counters. Defaults to phrase_counter.phrases.
+        """
+        self.phrases = dict(phrases)
+        # Each node is a dict of word -> node, and the key None of a node
+        # holds the term that ends there
+        self.trie: dict = {}
+        for phrase, shown_as in self.phrases.items():
+            node = self.trie
+            for word in phrase.lower().split():
+                node = node.setdefault(word, {})
+            node[None] = shown_as
+        # Identifies the terms, e.g. in the names of cached Stats, which have
+        # to be calculated again when the terms change
+        self.digest = hashlib.sha1(
+            json.dumps(sorted(self.phrases.items())).encode("utf8")
+        ).hexdigest()
+
+    def join(self, tokens: List[str]) -> List[str]:
+        """Replaces each term found in the tokens by a single token, as it is
+        shown (see PhraseCounter.__init__).
+
+            Args:
+                tokens (List[str]): lowercase words, e.g. Stats.tokens
+
+            Returns:
+                List[str]: the tokens, with the terms joined
+        """
+        joined = []
+        trie = self.trie
+        i = 0
+        while i < len(tokens):
+            node = trie.get(tokens[i])
+            found, end = None, i + 1
+            j = i + 1
+            while node is not None:
+                if None in node:
+                    found, end = node[None], j
+                if j == len(tokens):
+                    break
+                node = node.get(tokens[j])
+                j += 1
+            if found is None:
+                joined.append(tokens[i])
+            else:
+                joined.append(found)
+            i = end
+        return joined
@@ -1,58 +1,498 @@
 # This file contains functions to extract information about the repository, such
 # as number of commits, their ids, the date they were created, and so on
-# Uses gitpython to make the process easier
+# Uses git directly, through a few long running processes, to make it fast
 
-import git
+import fnmatch
+import json
+import os
+import posixpath
+import re
+import subprocess
+from typing import Iterator, List, Tuple
+from commit_sampling import sample_commits
 from config import thesis_path
+from latex_lexer import remove_comments
+
+# Regex translation: \input, \include or \includeonly, then either the file
+# names between {}, or, for \input, a file name after a space like TeX allows
+include_regex = re.compile(
+    r"\\(input|include|includeonly)(?:\s*{([^}]*)}|\s+([^\s{}\\]+))"
+)
+
+
+# One commit per line, as JSON, from the oldest to the newest, so messages with
+# any character are kept, and new commits are only appended to the end
+commit_index_file = "git_commits_info.jsonl"
+
+
+def _read_commit_index(filename: str) -> List[dict]:
+    """Reads the commits of the index, oldest first. A last line left
+    incomplete by an interrupted run is ignored, its commit is indexed again."""
+    commits = []
+    try:
+        fhand = open(filename, "r", encoding="utf8")
+    except FileNotFoundError:
+        return commits
+    with fhand:
+        for line in fhand:
+            if not line.endswith("\n"):
+                break
+            commits.append(json.loads(line))
+    return commits
+
+
+def _write_commit_index(filename: str, commits: List[dict]) -> None:
+    """Writes the whole index again, to another file first, so the index is
+    never left half written"""
+    partial = filename + ".partial"
+    with open(partial, "w", encoding="utf8") as fhand:
+        fhand.write(
+            "".join(json.dumps(commit, ensure_ascii=False) + "\n" for commit in commits)
+        )
+    os.replace(partial, filename)
+
+
+def _drop_incomplete_line(filename: str) -> None:
+    """Removes the end of the file after the last newline, left by a write
+    that was interrupted, so new lines are appended after complete ones"""
+    if not os.path.exists(filename):
+        return
+    with open(filename, "rb+") as fhand:
+        fhand.seek(0, os.SEEK_END)
+        size = fhand.tell()
+        if size == 0:
+            return
+        fhand.seek(size - 1)
+        if fhand.read(1) == b"\n":
+            return
+        fhand.seek(0)
+        fhand.truncate(fhand.read().rfind(b"\n") + 1)
+
+
+# Format of each commit in iter_commit_log: a record separator, then the sha,
+# tree, parents, unix date and the raw message, separated by NUL. With -z, the
+# --numstat lines that follow are "added\tdeleted\tpath" and also end in NUL.
+commit_log_format = "%x1e%H%x00%T%x00%P%x00%ct%x00%B%x00"
+
+
+def _parse_commit_record(record: bytes, numstat: bool) -> dict:
+    sha, tree, parents, time, message, files = record.split(b"\0", 5)
+    commit = {
+        "sha": sha.decode("ascii"),
+        "message": message.decode("utf8", errors="replace").rstrip(),
+        "time": int(time),
+        "parents": parents.decode("ascii").split(),
+        "tree": tree.decode("ascii"),
+        "changed": [],
+    }
+    if numstat:
+        commit["lines_added"] = commit["lines_deleted"] = 0
+    for entry in files.lstrip(b"\0\n").split(b"\0"):
+        if not entry:
+            continue
+        if numstat:
+            added, deleted, entry = entry.split(b"\t", 2)
+            # Binary files have "-" instead of numbers
+            commit["lines_added"] += int(added) if added != b"-" else 0
+            commit["lines_deleted"] += int(deleted) if deleted != b"-" else 0
+        commit["changed"].append(entry.decode("utf8", errors="replace"))
+    return commit
+
+
+def iter_commit_log(
+    revisions: List[str] = ("master",),
+    repo_path: str = thesis_path,
+    numstat: bool = True,
+) -> Iterator[dict]:
+    """Reads the metadata of many commits with a single `git log`, parsing
+    its output while it's being written, instead of asking for each commit
+    separately.
+
+        Args:
+            revisions (List[str], optional): passed to git log, e.g. a branch
+            and "^sha" for commits to leave out with their ancestors.
+            Defaults to ("master",).
+            repo_path (str, optional): Defaults to thesis_path.
+            numstat (bool, optional): also counts the lines added and
+            deleted. Most of the time is spent diffing the files for it, only
+            the changed paths are a lot faster. Defaults to True.
+        Yields:
+            dicts with "sha", "message", "time", "parents", "tree", "changed"
+            (paths changed from the first parent, renames are a deletion and
+            an addition) and, with numstat, "lines_added" and "lines_deleted",
+            from the oldest commit to the newest, parents before children.
+    """
+    process = subprocess.Popen(
+        [
+            "git",
+            "log",
+            "-z",
+            "--topo-order",
+            "--reverse",
+            "--no-renames",
+            "--diff-merges=first-parent",
+            "--numstat" if numstat else "--name-only",
+            f"--format={commit_log_format}",
+            *revisions,
+            "--",
+        ],
+        cwd=repo_path,
+        stdout=subprocess.PIPE,
+    )
+    pending = b""
+    finished = False
+    try:
+        for chunk in iter(lambda: process.stdout.read(1 << 16), b""):
+            records = (pending + chunk).split(b"\x1e")
+            pending = records.pop()
+            for record in records:
+                if record:
+                    yield _parse_commit_record(record, numstat)
+        if pending:
+            yield _parse_commit_record(pending, numstat)
+        finished = True
+    finally:
+        process.stdout.close()
+        if not finished:  # Stopped before the end
+            process.kill()
+        return_code = process.wait()
+    if return_code != 0:
+        raise RuntimeError(f"git log {' '.join(revisions)} failed in {repo_path}")
 
 
 def create_commit_list(
-    out_filename: str = "git_commits_info.txt"
+    out_filename: str = commit_index_file, repo_path: str = thesis_path
 ) -> list:
-    """Goes through the commits and generates an external text file that has the
-    sha, the commit message and the unix date.
+    """Updates the commit index, an external JSON lines file with, for each
+    commit, the sha, the commit message, the unix date, the parent shas, the
+    tree sha, the paths changed from the first parent and the number of lines
+    added and deleted. Only the commits that aren't in the index yet are read
+    (see iter_commit_log) and appended, so it's fast to run again after new
+    commits. Commits that aren't in master anymore, e.g. after an amend or a
+    rebase, are removed from the index.
 
+        Args:
+            out_filename (str): path to the index. Defaults to
+            commit_index_file.
+            repo_path (str, optional): Defaults to thesis_path.
         Returns:
-        List of dicts containing the same elements that were written to the file
+        List of dicts of all the commits, as load_commit_list
     """
-    repo = git.Repo(thesis_path)
-    repo.git.checkout('master', '--force')
-    commits = []
-    with open(out_filename, "w", encoding="utf8") as fhand:
-        # Write header to file
-        fhand.write("sha;message;timestamp\n")
-        for commit in repo.iter_commits():
-            sha = commit.hexsha
-            message = commit.message.rstrip()
-            # Needs to be converted afterwards to a datetime object. To store,
-            # will use the "pure" number.
-            date = commit.committed_date
-            fhand.write(f"{sha};{message};{date}\n")
-            commits.append({"sha": sha, "message": message, "date": date})
-    return commits
+    subprocess.run(
+        ["git", "checkout", "master", "--force"],
+        cwd=repo_path,
+        check=True,
+        capture_output=True,
+    )
+    indexed = _read_commit_index(out_filename)
+    _drop_incomplete_line(out_filename)
+    # Only the shas, so it's fast even for long histories
+    in_master = set(
+        subprocess.run(
+            ["git", "rev-list", "master"],
+            cwd=repo_path,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.split()
+    )
+    kept = [commit for commit in indexed if commit["sha"] in in_master]
+    if len(kept) != len(indexed):
+        print(f"{len(indexed) - len(kept)} commits aren't in master anymore, removed")
+        _write_commit_index(out_filename, kept)
+        indexed = kept
+    # Commits the index already has, with all their ancestors, are skipped
+    parents = {parent for commit in indexed for parent in commit["parents"]}
+    tips = [commit["sha"] for commit in indexed if commit["sha"] not in parents]
+    revisions = ["master"] + ["^" + sha for sha in tips]
+    new_commits = list(iter_commit_log(revisions, repo_path))
+    if new_commits:
+        with open(out_filename, "a", encoding="utf8") as fhand:
+            fhand.write(
+                "".join(
+                    json.dumps(commit, ensure_ascii=False) + "\n"
+                    for commit in new_commits
+                )
+            )
+    print(
+        f"{len(new_commits)} new commits, {len(indexed) + len(new_commits)} in total"
+    )
+    return list(reversed(indexed + new_commits))
 
 
-def load_commit_list(filename: str = "git_commits_info.txt") -> list:
-    """Goes through the file created in create_commit_list and generates a list
-    of dicts containing information about the commits
+def load_commit_list(
+    filename: str = commit_index_file, sampling: str = None
+) -> list:
+    """Reads the commit index created by create_commit_list, keeping only the
+    commits chosen by the sampling policy (see commit_sampling), so every stage
+    uses the same commits.
 
         Args:
             filename (str): path to file
+            sampling (str, optional): a policy like "bucket:1d" or "frames:300",
+            or "all". Defaults to the environment variable EVOLUTION_SAMPLING,
+            which keeps every commit if not set.
         Returns:
-            List of dicts containing "sha", "message", "time" as keys.
+            List of dicts, from the newest commit to the oldest, containing
+            "sha", "message", "time" (unix date, int), "parents", "tree" and
+            "changed" (paths changed from the first parent) as keys.
     """
-    lines = open(filename, "r", encoding="utf8").read()
-    commits = []
-    for i, line in enumerate(lines.split("\n")):
-        if i == 0:  # Skip the header
-            continue
-        if len(line) == 0:
-            continue
-        sha, message, time = line.split(";")
-        commits.append({"sha": sha, "message": message, "time": time})
-    return commits
+    commits = list(reversed(_read_commit_index(filename)))
+    return sample_commits(commits, sampling)
+
+
+def decode_text(data: bytes) -> str:
+    """Decodes the contents of a blob the same way `open_file` would read them
+    from the working tree, including the universal newlines translation."""
+    return data.decode("utf8").replace("\r\n", "\n").replace("\r", "\n")
+
+
+class BlobReader:
+    """Reads files straight from the git object database, without checking out
+    anything. Keeps a single `git cat-file --batch` process alive, so reading
+    many blobs costs one pipe round trip each instead of one process each.
+
+    Can be used as a context manager, so the process is closed afterwards.
+    """
+
+    def __init__(self, repo_path: str = thesis_path):
+        """
+        Args:
+            repo_path (str): path to the repository. Defaults to thesis_path.
+        """
+        self.repo_path = str(repo_path)
+        self.process = subprocess.Popen(
+            ("git", "cat-file", "--batch"),
+            cwd=self.repo_path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        # (tree sha, main file, pattern, fix_includeonly) -> sources, see
+        # list_sources
+        self._sources = {}
+
+    def __enter__(self) -> "BlobReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+        self.process.stdout.close()
+
+    def read(self, rev: str) -> Tuple[str, str, bytes]:
+        """Reads any object that git can resolve, e.g. a blob sha, "sha:path"
+        or "sha^{tree}".
+
+            Args:
+                rev (str): the object name
+            Returns:
+                Tuple with the object sha, the object type and its raw contents
+        """
+        self.process.stdin.write(rev.encode("utf8") + b"\n")
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().rstrip(b"\n")
+        # "<rev> missing" or "<rev> ambiguous", where the rev can have spaces
+        if header.endswith((b" missing", b" ambiguous")) or header.count(b" ") != 2:
+            raise KeyError(f"Object {rev} not found in {self.repo_path}")
+        object_sha, object_type, size = header.split()
+        data = self.process.stdout.read(int(size))
+        self.process.stdout.read(1)  # Trailing newline
+        return object_sha.decode(), object_type.decode(), data
+
+    def list_tree(
+        self, sha: str, filename_pattern: str = "*.tex"
+    ) -> List[Tuple[str, str]]:
+        """Lists the top level files of a commit that match `filename_pattern`,
+        the same files glob would find in a checkout of that commit.
+
+            Args:
+                sha (str): the commit sha
+                filename_pattern (str): glob-like pattern. Defaults to "*.tex".
+            Returns:
+                List of (path, blob sha) tuples
+        """
+        entries = []
+        for mode, name, blob_sha in self._tree_entries(sha + "^{tree}"):
+            if mode == b"40000" or mode == b"160000":  # Subtree or submodule
+                continue
+            if fnmatch.fnmatch(name, filename_pattern):
+                entries.append((name, blob_sha))
+        return entries
+
+    def walk_tree(self, sha: str) -> List[Tuple[str, str]]:
+        """Lists every file of a commit, in subfolders too, like
+        `git ls-tree -r`. Submodules are left out.
+
+            Args:
+                sha (str): the commit sha, or a tree sha
+            Returns:
+                List of (path, blob sha) tuples, paths separated by "/"
+        """
+        entries = []
+        trees = [("", sha + "^{tree}")]
+        while trees:
+            folder, tree_sha = trees.pop()
+            for mode, name, object_sha in self._tree_entries(tree_sha):
+                if mode == b"40000":
+                    trees.append((folder + name + "/", object_sha))
+                elif mode != b"160000":
+                    entries.append((folder + name, object_sha))
+        return sorted(entries)
+
+    def _tree_entries(self, rev: str) -> Iterator[Tuple[bytes, str, str]]:
+        """Reads the (mode, name, sha) entries of a tree object"""
+        _, _, data = self.read(rev)
+        # Binary tree format: "<mode> <name>\0<20 byte sha>", one after another
+        position = 0
+        while position < len(data):
+            space = data.index(b" ", position)
+            null = data.index(b"\0", space)
+            mode = data[position:space]
+            name = data[space + 1 : null].decode("utf8")
+            object_sha = data[null + 1 : null + 21].hex()
+            position = null + 21
+            yield mode, name, object_sha
+
+    def list_sources(
+        self,
+        sha: str,
+        filename_pattern: str = "*.tex",
+        main_file: str = "main.tex",
+        fix_includeonly: bool = True,
+    ) -> List[Tuple[str, str]]:
+        r"""Lists the files that end up in the document of a commit, following
+        \input and \include from the main file, in the order they appear.
+        Scratch and unused files are left out, and files in subfolders are
+        found. Without a main file, it's the same as list_tree. The result is
+        kept for each tree sha, so commits with the same tree are only
+        followed once.
+
+            Args:
+                sha (str): the commit sha
+                filename_pattern (str): only files matching it are listed,
+                although the includes of every file are followed. Defaults to
+                "*.tex".
+                main_file (str): Defaults to "main.tex".
+                fix_includeonly (bool): ignores \includeonly, the same way
+                latex_manip.compile_pdf_from_sha does, so the files are those
+                of the compiled pdf. If False, \include only adds the files
+                listed in \includeonly. Defaults to True.
+            Returns:
+                List of (path, blob sha) tuples
+        """
+        tree_sha, _, _ = self.read(sha + "^{tree}")
+        key = (tree_sha, filename_pattern, main_file, fix_includeonly)
+        if key not in self._sources:
+            self._sources[key] = self._follow_includes(
+                tree_sha, filename_pattern, main_file, fix_includeonly
+            )
+        return list(self._sources[key])
+
+    def _follow_includes(
+        self,
+        tree_sha: str,
+        filename_pattern: str,
+        main_file: str,
+        fix_includeonly: bool,
+    ) -> List[Tuple[str, str]]:
+        # Path -> blob sha of every file, so the included files are found
+        # without reading them, and each text is only read when its includes
+        # are followed. Never more than one text is kept.
+        blobs = dict(self.walk_tree(tree_sha))
+
+        def read_text(blob_sha: str) -> str:
+            _, _, data = self.read(blob_sha)
+            return remove_comments(decode_text(data))
+
+        if main_file not in blobs:
+            return self.list_tree(tree_sha, filename_pattern)
+        text = read_text(blobs[main_file])
+
+        includeonly = None
+        if not fix_includeonly:
+            for command, names, _ in include_regex.findall(text):
+                if command == "includeonly":
+                    includeonly = {name.strip() for name in names.split(",")}
+
+        sources = []
+        visited = {main_file}
+        # Depth first, so the files are in the order of the document
+        stack = [(main_file, blobs[main_file])]
+        while stack:
+            path, blob_sha = stack.pop()
+            text = read_text(blob_sha)
+            if fnmatch.fnmatch(posixpath.basename(path), filename_pattern):
+                sources.append((path, blob_sha))
+            included = []
+            for command, braced_name, bare_name in include_regex.findall(text):
+                name = (braced_name or bare_name).strip()
+                if command == "includeonly":
+                    continue
+                if command == "include" and includeonly is not None:
+                    if name not in includeonly:
+                        continue
+                # LaTeX tries the name with .tex first, then, for \input, the
+                # name as it is
+                candidates = [name]
+                if not name.endswith(".tex"):
+                    candidates = [name + ".tex"]
+                    if command == "input":
+                        candidates.append(name)
+                for candidate in candidates:
+                    candidate = posixpath.normpath(candidate)
+                    if candidate in visited:
+                        break
+                    if candidate in blobs:
+                        visited.add(candidate)
+                        included.append((candidate, blobs[candidate]))
+                        break
+            stack.extend(reversed(included))
+        return sources
+
+    def commit_date(self, sha: str) -> int:
+        """Gets the unix committed date of a commit, like
+        `git.Commit.committed_date`"""
+        _, _, data = self.read(sha)
+        for line in data.split(b"\n"):
+            if line.startswith(b"committer "):
+                return int(line.split()[-2])
+            if not line:  # End of headers
+                break
+        raise ValueError(f"Commit {sha} has no committer")
+
+    def iter_files(
+        self, sha: str, filename_pattern: str = "*.tex"
+    ) -> Iterator[Tuple[str, str, str]]:
+        """Yields the contents of the files of a commit that match
+        `filename_pattern`, without touching the working directory.
+
+            Args:
+                sha (str): the commit sha
+                filename_pattern (str): glob-like pattern. Defaults to "*.tex".
+            Yields:
+                (path, blob sha, text) tuples
+        """
+        return self.read_files(self.list_tree(sha, filename_pattern))
+
+    def read_files(
+        self, entries: List[Tuple[str, str]]
+    ) -> Iterator[Tuple[str, str, str]]:
+        """Reads, one at a time, the files listed by `list_tree`
+
+            Args:
+                entries (List[Tuple[str, str]]): (path, blob sha) tuples
+            Yields:
+                (path, blob sha, text) tuples
+        """
+        for path, blob_sha in entries:
+            _, _, data = self.read(blob_sha)
+            yield path, blob_sha, decode_text(data)
 
 
 def test_repo_info():
     create_commit_list()
-    print(load_commit_list("git_commits_info.txt"))
+    print(load_commit_list())
@@ -0,0 +1,93 @@
+# Used to find out which steps of Stats.calculate_stats take the most time and
+# memory. Set Stats.profiler to a StageProfiler, and every step run afterwards
+# is recorded, for every Stats, until it's set back to None.
+
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import List, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+class StageProfiler:
+    """Records the wall time, the size of the text before and after, and,
+    optionally, the peak of allocated memory of each named step (stage) of
+    Stats.calculate_stats. The records of all the Stats of a run are kept, so
+    they can be aggregated by stage with to_DataFrame."""
+
+    def __init__(self, trace_memory: bool = False):
+        """
+        Args:
+            trace_memory (bool, optional): also records the peak of memory
+            allocated during each stage, using tracemalloc. Makes everything
+            a few times slower. Defaults to False.
+        """
+        self.trace_memory = trace_memory
+        self.records: List[dict] = []
+
+    @contextmanager
+    def stage(self, name: str, text: str):
+        """Records one run of a stage. Yields the record, so the caller can
+        set "chars_out" once the stage is done.
+
+            Args:
+                name (str): name of the stage, e.g. "remove_comments"
+                text (str): the text the stage starts with
+        """
+        record = dict(stage=name, chars_in=len(text), chars_out=len(text))
+        if self.trace_memory:
+            if hasattr(tracemalloc, "reset_peak"):
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+            else:  # Python < 3.9, restarting is the only way to reset the peak
+                tracemalloc.stop()
+                tracemalloc.start()
+                baseline = 0
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            if self.trace_memory:
+                record["peak_bytes"] = tracemalloc.get_traced_memory()[1] - baseline
+            self.records.append(record)
+
+    def to_DataFrame(self) -> "pd.DataFrame":
+        """Aggregates the records by stage, from the slowest to the fastest
+        stage in total.
+
+            Returns:
+                pd.DataFrame: indexed by stage, with the number of calls, the
+                total and mean seconds, the share of the total time, the total
+                characters in and out and, if traced, the largest peak of
+                memory.
+        """
+        import pandas as pd
+
+        records = pd.DataFrame(self.records)
+        if records.empty:
+            return records
+        aggregations = dict(
+            calls=("seconds", "size"),
+            total_seconds=("seconds", "sum"),
+            mean_seconds=("seconds", "mean"),
+            chars_in=("chars_in", "sum"),
+            chars_out=("chars_out", "sum"),
+        )
+        if "peak_bytes" in records:
+            aggregations["max_peak_bytes"] = ("peak_bytes", "max")
+        table = records.groupby("stage", sort=False).agg(**aggregations)
+        table.insert(
+            3, "share_of_time", table["total_seconds"] / table["total_seconds"].sum()
+        )
+        return table.sort_values("total_seconds", ascending=False)
+
+    def save(self, filename: str) -> "pd.DataFrame":
+        """Saves the aggregated table as a csv file, and returns it"""
+        table = self.to_DataFrame()
+        table.to_csv(filename)
+        return table
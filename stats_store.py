@@ -0,0 +1,468 @@
+# Stores the Stats of every commit in a single SQLite file, instead of one
+# pickle per commit. The scalar metrics are one row per commit in the "stats"
+# table, so they can be read column by column without loading anything else.
+# The word counts (see Stats.encode), the other Counters and the cleaned text
+# are kept in their own tables, keyed by commit, and only loaded when asked.
+# The word ids only make sense with the vocabulary that gave them, so its uid
+# is kept in the metadata table and checked when they are added or loaded.
+
+import pickle
+import sqlite3
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import List, Union
+
+import numpy as np
+import pandas as pd
+
+from config import stats_basepath
+from text_stats import Stats, load_vocabulary, vocabulary_file
+
+# Stats attributes stored as columns of the stats table, besides commit_hash
+scalar_columns = (
+    "name",
+    "description",
+    "date",
+    "word_count",
+    "unique_word_count",
+    "stem_count",
+    "unique_stem_count",
+    "part_count",
+    "chapter_count",
+    "section_count",
+    "subsection_count",
+    "subsubsection_count",
+    "page_crossref",
+    "other_crossref",
+    "figure_count",
+    "subfigure_count",
+    "includegraphics_count",
+    "equation_counts",
+    "listing_count",
+    "inputminted",
+    "table_count",
+    "citation_counts",
+    "index_count",
+    "footnote_count",
+    "old_eq_count",
+    "display_eq_count",
+    "inline_eq_count",
+    "eq_env_count",
+    "subeq_env_count",
+)
+
+# Stats attributes stored, pickled, in the counters table
+Counter_attributes = (
+    "command_Counter",
+    "env_Counter",
+    "subfigures_in_figures_Counter",
+    "references_Counter",
+)
+
+# Stats attributes stored as columns of the file_stats table, for each file of a
+# commit, besides commit_hash and name (the path of the file)
+file_columns = tuple(
+    column
+    for column in scalar_columns
+    if column not in ("name", "description", "date")
+)
+
+# Names of the metrics in Stats.to_Series -> their column in the stats table.
+# The columns that aren't here keep their name in the history table.
+series_columns = {
+    "filename": "name",
+    "parts": "part_count",
+    "chapters": "chapter_count",
+    "sections": "section_count",
+    "subsections": "subsection_count",
+    "subsubsections": "subsubsection_count",
+    "page_cross_references": "page_crossref",
+    "figure_table_listing_cross_references": "other_crossref",
+    "figures": "figure_count",
+    "subfigures": "subfigure_count",
+    "includegraphics": "includegraphics_count",
+    "equations": "equation_counts",
+    "listings": "listing_count",
+    "intputminted": "inputminted",
+    "tables": "table_count",
+    "citations": "citation_counts",
+    "index_entries": "index_count",
+    "footnotes": "footnote_count",
+}
+
+# Metrics of Stats.to_Series that are the total of a Counter -> the Counter
+summed_Counters = {
+    "latex_command_count": "command_Counter",
+    "latex_env_count": "env_Counter",
+}
+
+history_file = Path(stats_basepath) / "history.csv"
+
+# Tables with the other data of each commit, and their columns besides
+# commit_hash, see StatsStore.copy
+copied_tables = {
+    "word_counts": "word_ids, word_counts",
+    "counters": "name, data",
+    "texts": "text",
+    "file_stats": "name, " + ", ".join(file_columns),
+}
+
+
+class StatsStore:
+    """One SQLite file with the Stats of all commits. Adding a commit is a
+    single insert, so the file is never rewritten."""
+
+    def __init__(
+        self, filename: Union[str, Path] = Path(stats_basepath) / "stats.sqlite"
+    ):
+        """
+        Args:
+            filename (str): path to the SQLite file. Defaults to
+            stats_basepath/stats.sqlite
+        """
+        self.filename = Path(filename)
+        self.connection = sqlite3.connect(str(self.filename))
+        columns = ", ".join(scalar_columns)
+        file_column_names = ", ".join(file_columns)
+        self.connection.executescript(
+            f"""
+            CREATE TABLE IF NOT EXISTS stats (
+                commit_hash TEXT PRIMARY KEY, {columns}
+            );
+            CREATE TABLE IF NOT EXISTS word_counts (
+                commit_hash TEXT PRIMARY KEY, word_ids BLOB, word_counts BLOB
+            );
+            CREATE TABLE IF NOT EXISTS counters (
+                commit_hash TEXT, name TEXT, data BLOB,
+                PRIMARY KEY (commit_hash, name)
+            );
+            CREATE TABLE IF NOT EXISTS texts (
+                commit_hash TEXT PRIMARY KEY, text BLOB
+            );
+            CREATE TABLE IF NOT EXISTS file_stats (
+                commit_hash TEXT, name TEXT, {file_column_names},
+                PRIMARY KEY (commit_hash, name)
+            );
+            CREATE TABLE IF NOT EXISTS metadata (
+                name TEXT PRIMARY KEY, value TEXT
+            );
+            """
+        )
+        # The vocabulary uid already checked, see check_vocabulary
+        self._checked_vocabulary_id = None
+
+    def __enter__(self) -> "StatsStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __contains__(self, commit_hash: str) -> bool:
+        row = self.connection.execute(
+            "SELECT 1 FROM stats WHERE commit_hash = ?", (commit_hash,)
+        ).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM stats").fetchone()[0]
+
+    @property
+    def vocabulary_id(self) -> Union[str, None]:
+        """The uid of the vocabulary of the word ids in the store (see
+        Vocabulary), None if nothing was added yet"""
+        row = self.connection.execute(
+            "SELECT value FROM metadata WHERE name = 'vocabulary_id'"
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def check_vocabulary(self, vocabulary_id: str) -> None:
+        """Makes sure the word ids in the store are from the vocabulary with
+        this uid. A store without word ids takes it.
+
+            Raises:
+                ValueError: the word ids are from another vocabulary, e.g.
+                vocabulary.npz was deleted or created again since they were
+                added. The stats have to be created again.
+        """
+        if vocabulary_id is not None and vocabulary_id == self._checked_vocabulary_id:
+            return
+        stored = self.vocabulary_id
+        if stored is None:
+            (word_counts,) = self.connection.execute(
+                "SELECT COUNT(*) FROM word_counts"
+            ).fetchone()
+            if not word_counts:
+                with self.connection:
+                    self.connection.execute(
+                        "INSERT INTO metadata VALUES ('vocabulary_id', ?)",
+                        (vocabulary_id,),
+                    )
+                stored = vocabulary_id
+        if stored is None or stored != vocabulary_id:
+            raise ValueError(
+                f"The word ids in {self.filename} are from another vocabulary "
+                f"than {vocabulary_file}. Delete the store and create the stats "
+                "again."
+            )
+        self._checked_vocabulary_id = vocabulary_id
+
+    def append(self, st: Stats) -> None:
+        """Adds (or replaces) the Stats of a commit. The Stats is encoded, if it
+        wasn't already, and must be encoded with the vocabulary of the store
+        (see check_vocabulary)."""
+        if st.word_ids is None:
+            st.encode()
+        self.check_vocabulary(st.vocabulary_id)
+        values = [st.commit_hash] + [getattr(st, name) for name in scalar_columns]
+        placeholders = ", ".join("?" * len(values))
+        with self.connection:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO stats VALUES ({placeholders})", values
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO word_counts VALUES (?, ?, ?)",
+                (
+                    st.commit_hash,
+                    st.word_ids.astype(np.int32).tobytes(),
+                    st.word_counts.astype(np.int32).tobytes(),
+                ),
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO counters VALUES (?, ?, ?)",
+                [
+                    (st.commit_hash, name, pickle.dumps(getattr(st, name)))
+                    for name in Counter_attributes
+                ],
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO texts VALUES (?, ?)",
+                (st.commit_hash, zlib.compress(st.text.encode("utf8"))),
+            )
+
+    def append_files(self, list_of_Stats: List[Stats]) -> None:
+        """Adds (or replaces) the scalar metrics of each file of a commit (see
+        create_stats_from_sha with merge=False)"""
+        placeholders = ", ".join("?" * (len(file_columns) + 2))
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO file_stats VALUES ({placeholders})",
+                [
+                    [st.commit_hash, st.name]
+                    + [getattr(st, column) for column in file_columns]
+                    for st in list_of_Stats
+                ],
+            )
+
+    def copy(self, source_hash: str, commit_hash: str, **columns) -> None:
+        """Stores the Stats of a commit again, under another commit_hash, e.g.
+        for a commit with the same .tex files. Nothing is decoded, the rows are
+        copied inside the database.
+
+            Args:
+                source_hash (str): commit already in the store
+                commit_hash (str): the new commit
+                **columns: scalar columns that change, like the date
+        """
+        row = self.connection.execute(
+            "SELECT * FROM stats WHERE commit_hash = ?", (source_hash,)
+        ).fetchone()
+        values = dict(zip(("commit_hash",) + scalar_columns, row))
+        values.update(columns, commit_hash=commit_hash)
+        placeholders = ", ".join("?" * len(values))
+        with self.connection:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO stats VALUES ({placeholders})",
+                list(values.values()),
+            )
+            for table, table_columns in copied_tables.items():
+                self.connection.execute(
+                    f"INSERT OR REPLACE INTO {table} SELECT ?, {table_columns} "
+                    f"FROM {table} WHERE commit_hash = ?",
+                    (commit_hash, source_hash),
+                )
+
+    def load_columns(self, columns: List[str] = None) -> pd.DataFrame:
+        """Loads only the columns asked for, for every commit, sorted by date.
+
+            Args:
+                columns (List[str], optional): names from scalar_columns.
+                Defaults to all of them.
+
+            Returns:
+                pd.DataFrame: indexed by commit_hash
+        """
+        if columns is None:
+            columns = list(scalar_columns)
+        for column in columns:
+            if column not in scalar_columns:
+                raise KeyError(f"{column} is not a column of the stats store")
+        selected = ", ".join(["commit_hash"] + list(columns))
+        return pd.read_sql_query(
+            f"SELECT {selected} FROM stats ORDER BY date", self.connection
+        ).set_index("commit_hash")
+
+    def load_file_series(self, column: str = "word_count") -> pd.DataFrame:
+        """Loads one metric of every file, for every commit added with
+        append_files, e.g. the number of words of each chapter over time.
+
+            Args:
+                column (str, optional): one of file_columns. Defaults to
+                "word_count".
+
+            Returns:
+                pd.DataFrame: indexed by commit_hash, sorted by date, with one
+                column per file. Files that didn't exist in a commit are 0.
+        """
+        if column not in file_columns:
+            raise KeyError(f"{column} is not a column of the file stats")
+        table = pd.read_sql_query(
+            f"SELECT file_stats.commit_hash, file_stats.name, file_stats.{column} "
+            "FROM file_stats JOIN stats USING (commit_hash) ORDER BY stats.date",
+            self.connection,
+        )
+        order = list(dict.fromkeys(table["commit_hash"]))
+        return (
+            table.pivot(index="commit_hash", columns="name", values=column)
+            .reindex(order)
+            .fillna(0)
+        )
+
+    def load_history(self) -> pd.DataFrame:
+        """Loads every scalar metric of Stats.to_Series, for every commit, as
+        a single table, with a couple of queries instead of one Stats per
+        commit.
+
+            Returns:
+                pd.DataFrame: indexed by commit_hash, sorted by date, with the
+                column names of Stats.to_Series (see series_columns). The date
+                is a UTC datetime column.
+        """
+        table = self.load_columns()
+        table = table.rename(
+            columns={column: name for name, column in series_columns.items()}
+        )
+        for name, attribute in summed_Counters.items():
+            totals = {
+                commit_hash: sum(pickle.loads(data).values())
+                for commit_hash, data in self.connection.execute(
+                    "SELECT commit_hash, data FROM counters WHERE name = ?",
+                    (attribute,),
+                )
+            }
+            table[name] = table.index.map(totals).fillna(0).astype(int)
+        table["date"] = pd.to_datetime(
+            table["date"].astype("int64"), unit="s", utc=True
+        )
+        return table
+
+    def export_history(
+        self, filename: Union[str, Path] = history_file
+    ) -> pd.DataFrame:
+        """Saves load_history as a single file, for plotting and analysis.
+
+            Args:
+                filename (Union[str, Path], optional): a .csv or .parquet
+                file. Parquet needs pyarrow or fastparquet, and keeps the
+                types. Defaults to stats_basepath/history.csv.
+
+            Returns:
+                pd.DataFrame: the table saved
+        """
+        filename = Path(filename)
+        table = self.load_history()
+        if filename.suffix == ".parquet":
+            table.to_parquet(filename)
+        elif filename.suffix == ".csv":
+            table.to_csv(filename)
+        else:
+            raise ValueError(
+                f"Can't save the history as {filename.suffix}, use .csv or .parquet"
+            )
+        return table
+
+    def load_word_counts(self, commit_hash: str):
+        """Loads the word ids and counts of a commit (see Stats.encode). They
+        must be from the vocabulary of the run (see check_vocabulary)."""
+        self.check_vocabulary(load_vocabulary().uid)
+        word_ids, word_counts = self.connection.execute(
+            "SELECT word_ids, word_counts FROM word_counts WHERE commit_hash = ?",
+            (commit_hash,),
+        ).fetchone()
+        return (
+            np.frombuffer(word_ids, dtype=np.int32),
+            np.frombuffer(word_counts, dtype=np.int32),
+        )
+
+    def load_Counter(self, commit_hash: str, name: str) -> Counter:
+        """Loads one of the Counter_attributes of a commit"""
+        (data,) = self.connection.execute(
+            "SELECT data FROM counters WHERE commit_hash = ? AND name = ?",
+            (commit_hash, name),
+        ).fetchone()
+        return pickle.loads(data)
+
+    def load_text(self, commit_hash: str) -> str:
+        """Loads the cleaned text of a commit"""
+        (data,) = self.connection.execute(
+            "SELECT text FROM texts WHERE commit_hash = ?", (commit_hash,)
+        ).fetchone()
+        return zlib.decompress(data).decode("utf8")
+
+    def load_Stats(
+        self,
+        columns: List[str] = None,
+        word_counts: bool = True,
+        Counters: List[str] = (),
+        text: bool = False,
+    ) -> List[Stats]:
+        """Recreates Stats objects for every commit, sorted by date, but only
+        with the attributes asked for. Good enough for create_figure, without
+        loading what isn't needed.
+
+            Args:
+                columns (List[str], optional): scalar columns to load. Defaults
+                to all of them.
+                word_counts (bool, optional): loads word_ids and word_counts, so
+                the word and stem Counters work. Defaults to True.
+                Counters (List[str], optional): which of Counter_attributes to
+                load. Defaults to none.
+                text (bool, optional): loads the cleaned text. Defaults to False.
+
+            Returns:
+                List[Stats]: one Stats per commit, from oldest to newest
+        """
+        table = self.load_columns(columns)
+        list_of_Stats = []
+        for commit_hash, row in zip(table.index, table.to_dict("records")):
+            st = Stats(row.get("name", "all"), "", commit_hash=commit_hash)
+            for column, value in row.items():
+                setattr(st, column, value)
+            if word_counts:
+                st.word_ids, st.word_counts = self.load_word_counts(commit_hash)
+                st.vocabulary_id = self._checked_vocabulary_id
+            for name in Counters:
+                setattr(st, name, self.load_Counter(commit_hash, name))
+            if text:
+                st.text = self.load_text(commit_hash)
+            list_of_Stats.append(st)
+        return list_of_Stats
+
+
+def read_history(filename: Union[str, Path] = history_file) -> pd.DataFrame:
+    """Reads a file saved by StatsStore.export_history, with the same types
+    (the dates are parsed back from a .csv)"""
+    filename = Path(filename)
+    if filename.suffix == ".parquet":
+        return pd.read_parquet(filename)
+    table = pd.read_csv(
+        filename,
+        index_col="commit_hash",
+        dtype={"filename": str, "description": str},
+        keep_default_na=False,
+    )
+    table["date"] = pd.to_datetime(table["date"], utc=True)
+    return table
@@ -0,0 +1,5 @@
+# The modules are at the root of the repository, next to main.py
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+import latex_lexer
+import text_stats
+
+# Quadratic scans took seconds with this many tokens on one line, a linear one
+# takes a few hundredths of a second
+tokens = 20000
+
+# Commands whose closing delimiter is searched for in the rest of the line
+unclosed_commands = [
+    "\\( ", "\\label{ ", "\\index{ ", "\\cite{ ", "\\citeauthor{ ",
+    "\\includegraphics[ ", "\\includegraphics{ ", "\\inputminted{python}{ ",
+    "\\ref[ ", "\\ref{ ", "\\autoref{ ", "\\begin[ ", "\\end[ ",
+]
+
+
+def lex_seconds(text: str) -> float:
+    start = time.perf_counter()
+    latex_lexer.lex(text)
+    return time.perf_counter() - start
+
+
+def regex_tokens(text: str) -> list:
+    stats = text_stats.Stats("test", text)
+    stats.debug = False
+    stats.clean_text_with_regexes()
+    return stats.tokens
+
+
+def lexer_tokens(text: str) -> list:
+    stats = text_stats.Stats("test", text)
+    stats.debug = False
+    stats.remove_comments_in_one_pass()
+    stats.lex_text()
+    stats.tokenize_text()
+    return stats.tokens
+
+
+@pytest.mark.parametrize("command", unclosed_commands)
+def test_unclosed_command_is_linear(command):
+    assert lex_seconds((command + "a ") * tokens) < 1
+
+
+def test_unclosed_inline_equation_is_linear():
+    assert lex_seconds("\\( " + "\\x " * tokens) < 1
+
+
+def test_unclosed_ref_options_are_linear():
+    assert lex_seconds("\\autoref[ " + "\\ref{a} " * tokens) < 1
+
+
+def test_unclosed_environment_options_are_linear():
+    assert lex_seconds("\\begin[ " + "\\begin{a} " * tokens) < 1
+
+
+def test_failed_patterns_match_again_on_the_next_line():
+    lexed = latex_lexer.lex("\\( a\n\\( b \\) \\ref[x\n\\ref[y]{z} w")
+    assert lexed["inline_eq_count"] == 1
+    assert lexed["clean_text"] == "\\( a\n [x\n w"
+
+
+def test_balanced_commands_match_the_regexes():
+    text = ("palavra \\label{fig:a} \\index{termo} \\cite{r1} outra "
+            "\\citeauthor{r2} \\ref{fig:a} \\autoref{eq} \\ref[p]{x} texto\n"
+            "\\includegraphics[width=3cm]{a.png} \\includegraphics{b.pdf} "
+            "\\inputminted{python}{c.py} \\( x \\) \\[ y \\] $z$ $$w$$ fim\n"
+            "\\begin{figure}\\begin{subfigure}legenda\\end{subfigure}"
+            "\\end{figure}\n\\begin{equation} a=b \\end{equation} \\ref{a b}\n")
+    assert lexer_tokens(text) == regex_tokens(text)
+
+
+@pytest.mark.parametrize("text", [
+    "a \\cite{x b \\label{y} c",
+    "w \\index{ b \\label{z} r",
+    "a \\ref[x] b \\includegraphics[w]{f} c",
+])
+def test_later_command_closes_the_delimiter(text):
+    # Documented difference: the regexes remove the later command first, the
+    # lexer removes everything up to its delimiter
+    assert "b" in regex_tokens(text)
+    assert "b" not in lexer_tokens(text)
@@ -0,0 +1,70 @@
+import subprocess
+
+import pytest
+
+import repo_info
+
+
+def git(repo, *arguments):
+    return subprocess.run(
+        ["git", *arguments], cwd=repo, check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+def commit_file(repo, name, text, message, *options):
+    (repo / name).write_text(text)
+    git(repo, "add", name)
+    git(repo, "commit", "-q", "-m", message, *options)
+    return git(repo, "rev-parse", "HEAD")
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    for variable in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv(f"GIT_{variable}_NAME", "Test")
+        monkeypatch.setenv(f"GIT_{variable}_EMAIL", "test@example.com")
+    repo = tmp_path / "thesis"
+    repo.mkdir()
+    git(repo, "init", "-q", "-b", "master")
+    commit_file(repo, "main.tex", "first\n", "first")
+    commit_file(repo, "main.tex", "second\n", "second")
+    return repo
+
+
+def test_create_commit_list_after_amend(repo, tmp_path):
+    index = str(tmp_path / "commits.jsonl")
+    first, second = [
+        commit["sha"] for commit in repo_info.create_commit_list(index, str(repo))
+    ][::-1]
+    amended = commit_file(repo, "main.tex", "amended\n", "amended", "--amend")
+    # The amended commit is gone for good, as after a gc
+    git(repo, "reflog", "expire", "--expire=now", "--all")
+    git(repo, "gc", "-q", "--prune=now")
+
+    commits = repo_info.create_commit_list(index, str(repo))
+
+    assert [commit["sha"] for commit in commits] == [amended, first]
+    assert commits == repo_info.load_commit_list(index, sampling="all")
+    assert second not in open(index).read()
+    # Nothing new the next time
+    assert repo_info.create_commit_list(index, str(repo)) == commits
+
+
+def test_read_missing_name_with_spaces(repo):
+    with repo_info.BlobReader(str(repo)) as reader:
+        with pytest.raises(KeyError):
+            reader.read("HEAD^{tree}:my file.tex")
+        with pytest.raises(KeyError):
+            reader.read("HEAD^{tree}:a b c.tex")
+        # The reader still answers after the errors
+        assert reader.read("HEAD:main.tex")[1:] == ("blob", b"second\n")
+
+
+def test_list_sources_with_missing_input_with_spaces(repo):
+    commit_file(repo, "chapter one.tex", "one\n", "chapter")
+    commit_file(
+        repo, "main.tex", "\\input{my file}\n\\input{chapter one}\n", "inputs"
+    )
+    with repo_info.BlobReader(str(repo)) as reader:
+        sources = reader.list_sources("HEAD")
+    assert [path for path, _ in sources] == ["main.tex", "chapter one.tex"]
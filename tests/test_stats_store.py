@@ -0,0 +1,37 @@
+import pytest
+
+import text_stats
+from stats_store import StatsStore
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(text_stats, "_vocabulary", text_stats.Vocabulary())
+    st = text_stats.Stats(
+        "all", "A tese tem palavras e mais palavras.", commit_hash="a", date=0
+    )
+    st.calculate_stats()
+    with StatsStore(tmp_path / "stats.sqlite") as store:
+        store.append(st)
+        yield store
+
+
+def test_word_counts_are_decoded_with_the_same_vocabulary(store):
+    (st,) = store.load_Stats()
+    assert st.word_Counter["palavras"] == 2
+
+
+def test_word_ids_from_another_vocabulary_are_rejected(store, monkeypatch):
+    monkeypatch.setattr(text_stats, "_vocabulary", text_stats.Vocabulary())
+    with pytest.raises(ValueError):
+        store.load_Stats()
+    st = text_stats.Stats("all", "Outra tese.", commit_hash="b", date=1)
+    st.calculate_stats()
+    with pytest.raises(ValueError):
+        store.append(st)
+
+
+def test_vocabulary_uid_is_saved(tmp_path):
+    vocabulary = text_stats.Vocabulary()
+    vocabulary.save(tmp_path / "vocabulary.npz")
+    assert text_stats.Vocabulary.load(tmp_path / "vocabulary.npz").uid == vocabulary.uid
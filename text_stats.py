@@ -1,35 +1,29 @@
 # Used to create stats of a specific commit, such as the number of pages of the
 # pdf file, the number of words, number of sections, etc
 
-from config import thesis_path, stats_basepath
+from config import thesis_path, stats_basepath, stats_cache_path
 import os
 import glob
 import re
 from collections import Counter
 import pathlib
-from typing import Union, List
-import pandas as pd
+import multiprocessing
+from typing import Union, List, Tuple, Iterable, TYPE_CHECKING
+import numpy as np
 import pickle
-import git
-from repo_info import load_commit_list
-
-try:
-    import nltk
-except ModuleNotFoundError:
-    print("Please install nltk")
-try:
-    nltk.data.find("corpora/stopwords")
-except LookupError:
-    nltk.download("stopwords")
-try:
-    from nltk.stem import rslp
-except LookupError:
-    nltk.download("rslp")
-try:
-    from nltk.stem.snowball import SnowballStemmer
-except LookupError:
-    nltk.download("snowball_data")
-
+import copy
+import uuid
+from repo_info import load_commit_list, BlobReader, decode_text
+import latex_lexer
+from content_hash import content_hashes, tex_tree_hash
+from phrase_counter import PhraseCounter
+from stage_profiler import StageProfiler
+import nlp_resources
+
+# Only imported when used, so importing this module stays fast
+if TYPE_CHECKING:
+    import git
+    import pandas as pd
 
 def open_file(filepath: Union[str, pathlib.Path]) -> str:
     """Opens a file"""
@@ -37,10 +31,283 @@ def open_file(filepath: Union[str, pathlib.Path]) -> str:
     return text
 
 
+# Stems of every word seen so far, shared by all the Stats of a run and saved in
+# stats_cache_path between runs. Loaded on the first use, see stem_words.
+stem_cache_file = pathlib.Path(stats_cache_path) / "stems.pkl"
+_stem_cache = None
+# Words stemmed since the cache was loaded, saved or taken by take_new_stems
+_new_stems = {}
+
+
+def load_stem_cache() -> dict:
+    """Loads the stems saved by previous runs, if any."""
+    global _stem_cache
+    if _stem_cache is None:
+        _stem_cache = {}
+        if stem_cache_file.is_file():
+            with open(stem_cache_file, "rb") as fhand:
+                _stem_cache = pickle.load(fhand)
+    return _stem_cache
+
+
+def take_new_stems() -> dict:
+    """The words stemmed since the last call, so a worker process can send
+    them to the one that saves the cache (see add_stems)."""
+    global _new_stems
+    new_stems, _new_stems = _new_stems, {}
+    return new_stems
+
+
+def add_stems(stems: dict) -> None:
+    """Adds stems from another process to the cache, to be saved by
+    save_stem_cache."""
+    load_stem_cache().update(stems)
+    _new_stems.update(stems)
+
+
+def save_stem_cache() -> None:
+    """Saves the stems to disk, if any new word was stemmed. Other processes
+    may have saved in the meantime, so their stems are kept too."""
+    if not _new_stems:
+        return
+    cache = load_stem_cache()
+    if stem_cache_file.is_file():
+        with open(stem_cache_file, "rb") as fhand:
+            cache.update(pickle.load(fhand))
+    os.makedirs(stem_cache_file.parent, exist_ok=True)
+    temporary_file = stem_cache_file.with_suffix(f".{os.getpid()}.tmp")
+    with open(temporary_file, "wb") as fhand:
+        pickle.dump(cache, fhand)
+    os.replace(temporary_file, stem_cache_file)
+    _new_stems.clear()
+
+
+def stem_words(words) -> dict:
+    """Gets the stems of a whole vocabulary at once, using SnowballStemmer.
+    Words that were already stemmed, in this run or a previous one, are taken
+    from the cache.
+
+        Args:
+            words (iterable of str): the words, e.g. a list or a Counter
+
+        Returns:
+            dict: word -> stem, for every word given
+    """
+    cache = load_stem_cache()
+    stems = {}
+    for word in words:
+        stem = cache.get(word)
+        if stem is None:
+            stem = cache[word] = nlp_resources.snowball_stemmer().stem(word)
+            _new_stems[word] = stem
+        stems[word] = stem
+    return stems
+
+
+def count_stems(word_Counter: Counter) -> Counter:
+    """Creates a Counter of stems from a Counter of words, so each distinct
+    word is stemmed once, not once per occurrence"""
+    stems = stem_words(word_Counter)
+    stem_Counter = Counter()
+    for word, count in word_Counter.items():
+        stem_Counter[stems[word]] += count
+    return stem_Counter
+
+
+class Vocabulary:
+    """Interns words and stems to integer ids, so the word counts of a Stats
+    can be kept as two np.int32 arrays (see Stats.encode) instead of Counters.
+    The stem of each word and whether it is a stopword are kept as arrays
+    indexed by the word id, so the other Counters of a Stats come out of the
+    word counts with array operations. Ids never change once given, so the
+    same vocabulary is reused by all the Stats of a history. Each new
+    vocabulary gets a random uid, so ids given by another one (e.g. after
+    vocabulary.npz was deleted) are detected, see Stats.encode.
+    """
+
+    def __init__(self):
+        self.uid = uuid.uuid4().hex
+        self.words: List[str] = []
+        self.ids: dict = {}
+        self.stems: List[str] = []
+        self.stem_ids: dict = {}
+        self.word_stem = np.zeros(0, dtype=np.int32)
+        self.is_stopword = np.zeros(0, dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def intern(self, words: List[str]) -> np.ndarray:
+        """Gets the ids of words, adding the ones not seen before"""
+        new_words = [word for word in dict.fromkeys(words) if word not in self.ids]
+        if new_words:
+            stems = stem_words(new_words)
+            stopwords = nlp_resources.stopwords()
+            new_word_stems = []
+            for word in new_words:
+                self.ids[word] = len(self.words)
+                self.words.append(word)
+                stem = stems[word]
+                if stem not in self.stem_ids:
+                    self.stem_ids[stem] = len(self.stems)
+                    self.stems.append(stem)
+                new_word_stems.append(self.stem_ids[stem])
+            self.word_stem = np.concatenate(
+                (self.word_stem, np.array(new_word_stems, dtype=np.int32))
+            )
+            self.is_stopword = np.concatenate(
+                (
+                    self.is_stopword,
+                    np.array([word in stopwords for word in new_words], dtype=bool),
+                )
+            )
+        return np.array([self.ids[word] for word in words], dtype=np.int32)
+
+    def encode(self, word_Counter: Counter) -> Tuple[np.ndarray, np.ndarray]:
+        """Converts a Counter of words into arrays of word ids and counts, in
+        the same order as the Counter"""
+        ids = self.intern(list(word_Counter))
+        counts = np.fromiter(
+            word_Counter.values(), dtype=np.int32, count=len(word_Counter)
+        )
+        return ids, counts
+
+    def remove_stopwords(
+        self, ids: np.ndarray, counts: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Keeps only the ids and counts of words that are not stopwords"""
+        keep = ~self.is_stopword[ids]
+        return ids[keep], counts[keep]
+
+    def count_stems(
+        self, ids: np.ndarray, counts: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Adds up the counts of words with the same stem. Returns stem ids and
+        counts, in the order each stem first appears."""
+        word_stems = self.word_stem[ids]
+        stem_ids, first, inverse = np.unique(
+            word_stems, return_index=True, return_inverse=True
+        )
+        stem_counts = np.bincount(inverse, weights=counts).astype(np.int32)
+        order = np.argsort(first)
+        return stem_ids[order], stem_counts[order]
+
+    def to_Counter(
+        self, ids: np.ndarray, counts: np.ndarray, stems: bool = False
+    ) -> Counter:
+        """Converts ids and counts back into a Counter of words (or stems)"""
+        names = self.stems if stems else self.words
+        return Counter(dict(zip([names[i] for i in ids.tolist()], counts.tolist())))
+
+    def most_common(
+        self, ids: np.ndarray, counts: np.ndarray, n: int, stems: bool = False
+    ) -> list:
+        """Same as Counter.most_common, without creating the Counter"""
+        names = self.stems if stems else self.words
+        order = np.argsort(-counts, kind="stable")[:n]
+        return [
+            (names[i], count)
+            for i, count in zip(ids[order].tolist(), counts[order].tolist())
+        ]
+
+    def to_dense(
+        self, ids: np.ndarray, counts: np.ndarray, stems: bool = False
+    ) -> np.ndarray:
+        """Creates a vector with the count of every word (or stem) of the
+        vocabulary, so Stats of different commits can be compared directly."""
+        vector = np.zeros(len(self.stems if stems else self.words), dtype=np.int32)
+        vector[ids] = counts
+        return vector
+
+    def save(self, filename: Union[str, pathlib.Path]) -> None:
+        temporary_file = str(filename) + ".tmp.npz"
+        np.savez(
+            temporary_file,
+            uid=np.array(self.uid),
+            words=np.array(self.words, dtype=str),
+            stems=np.array(self.stems, dtype=str),
+            word_stem=self.word_stem,
+            is_stopword=self.is_stopword,
+        )
+        os.replace(temporary_file, filename)
+
+    @classmethod
+    def load(cls, filename: Union[str, pathlib.Path]) -> "Vocabulary":
+        vocabulary = cls()
+        with np.load(filename) as data:
+            # Vocabularies saved without one keep the new uid, so the stats
+            # encoded with them have to be created again
+            if "uid" in data:
+                vocabulary.uid = str(data["uid"])
+            vocabulary.words = data["words"].tolist()
+            vocabulary.stems = data["stems"].tolist()
+            vocabulary.word_stem = data["word_stem"]
+            vocabulary.is_stopword = data["is_stopword"]
+        vocabulary.ids = {word: i for i, word in enumerate(vocabulary.words)}
+        vocabulary.stem_ids = {stem: i for i, stem in enumerate(vocabulary.stems)}
+        return vocabulary
+
+
+# The ids in the pickled Stats refer to this file, so it must be kept with them
+vocabulary_file = pathlib.Path(stats_basepath) / "vocabulary.npz"
+_vocabulary = None
+
+
+def load_vocabulary() -> Vocabulary:
+    """Gets the vocabulary of this run, loading the saved one the first time"""
+    global _vocabulary
+    if _vocabulary is None:
+        if vocabulary_file.is_file():
+            _vocabulary = Vocabulary.load(vocabulary_file)
+        else:
+            _vocabulary = Vocabulary()
+    return _vocabulary
+
+
+def save_vocabulary() -> None:
+    if _vocabulary is not None:
+        os.makedirs(vocabulary_file.parent, exist_ok=True)
+        _vocabulary.save(vocabulary_file)
+
+
 # TODO: is this a good way of implementing the class? I think I need some
 # decorators, getters and setters
 class Stats:
     debug = False
+    # Use the single pass lexer instead of the regex substitutions
+    use_lexer = True
+    # Set to a stage_profiler.StageProfiler to record the time (and memory) of
+    # each step of calculate_stats
+    profiler = None
+    # Terms counted as a single word, see join_phrases
+    phrase_counter = PhraseCounter()
+
+    # How each calculated attribute is combined when merging Stats, see merge
+    _summed_attributes = (
+        "old_eq_count",
+        "display_eq_count",
+        "inline_eq_count",
+        "eq_env_count",
+        "subeq_env_count",
+        "stem_count",
+    )
+    _concatenated_attributes = ("references_Counter",)
+    # Counters that can be recreated from word_ids and word_counts, see encode
+    _encoded_Counters = (
+        "word_Counter",
+        "reduced_word_Counter",
+        "stem_Counter",
+        "nonstopping_stem_Counter",
+    )
+    _Counter_attributes = (
+        "command_Counter",
+        "env_Counter",
+        "subfigures_in_figures_Counter",
+        "word_Counter",
+        "reduced_word_Counter",
+        "stem_Counter",
+        "nonstopping_stem_Counter",
+    )
 
     def __init__(
         self,
@@ -76,12 +343,95 @@ class Stats:
         self.commit_hash = commit_hash
         self.number_most_common = number_most_common
         self.date = date
+        self.word_ids = None
+        self.word_counts = None
+        self.vocabulary_id = None
+        self._word_Counter = None
+        self._reduced_word_Counter = None
+        self._stem_Counter = None
+        self._nonstopping_stem_Counter = None
+        self._environments = None
+        self._environments_text = None
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        # Once encoded, the Counters can be recreated from the arrays, so they
+        # are not pickled
+        if state.get("word_ids") is not None:
+            for attribute in self._encoded_Counters:
+                state["_" + attribute] = None
+        # The tree of environments is only needed while calculating
+        state["_environments"] = state["_environments_text"] = None
+        # re.Match objects can't be pickled, the matched text is enough
+        if "_old_eq_count_DEBUG" in state:
+            state["_old_eq_count_DEBUG"] = [
+                getattr(match, "group", lambda: match)()
+                for match in state["_old_eq_count_DEBUG"]
+            ]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        # Stats pickled before encoding existed have the Counters directly
+        for attribute in self._encoded_Counters:
+            if attribute in state:
+                state["_" + attribute] = state.pop(attribute)
+        state.setdefault("word_ids", None)
+        state.setdefault("vocabulary_id", None)
+        self.__dict__.update(state)
+
+    def encode(self, vocabulary: Vocabulary = None) -> None:
+        """Keeps the words of the word Counter as ids of the vocabulary and
+        their counts, as np.int32 arrays (word_ids and word_counts). When
+        pickled, only these arrays are stored, and the word, reduced word, stem
+        and nonstopping stem Counters are recreated from them when needed.
+
+            Args:
+                vocabulary (Vocabulary, optional): Defaults to the vocabulary
+                of the run, see load_vocabulary. It has to be saved together
+                with the pickles. Its uid is kept in vocabulary_id, and the
+                Counters are only decoded with the same vocabulary.
+        """
+        if vocabulary is None:
+            vocabulary = load_vocabulary()
+        self.word_ids, self.word_counts = vocabulary.encode(self.word_Counter)
+        self.vocabulary_id = vocabulary.uid
+
+    def _decode_Counter(self, attribute: str) -> Counter:
+        vocabulary = load_vocabulary()
+        if self.vocabulary_id != vocabulary.uid:
+            raise ValueError(
+                f"The word ids of {self.commit_hash} are from another vocabulary "
+                f"than {vocabulary_file}, their Stats have to be created again"
+            )
+        ids, counts = self.word_ids, self.word_counts
+        if attribute in ("reduced_word_Counter", "nonstopping_stem_Counter"):
+            ids, counts = vocabulary.remove_stopwords(ids, counts)
+        if attribute in ("stem_Counter", "nonstopping_stem_Counter"):
+            ids, counts = vocabulary.count_stems(ids, counts)
+            return vocabulary.to_Counter(ids, counts, stems=True)
+        return vocabulary.to_Counter(ids, counts)
+
+    def _encoded_Counter_property(attribute: str):
+        def getter(self) -> Counter:
+            if getattr(self, "_" + attribute) is None:
+                setattr(self, "_" + attribute, self._decode_Counter(attribute))
+            return getattr(self, "_" + attribute)
+
+        def setter(self, value: Counter) -> None:
+            setattr(self, "_" + attribute, value)
+
+        return property(getter, setter)
+
+    word_Counter = _encoded_Counter_property("word_Counter")
+    reduced_word_Counter = _encoded_Counter_property("reduced_word_Counter")
+    stem_Counter = _encoded_Counter_property("stem_Counter")
+    nonstopping_stem_Counter = _encoded_Counter_property("nonstopping_stem_Counter")
+    del _encoded_Counter_property
 
     def tokenize_text(self) -> None:
         """Creates a long list of all the words in the text, excluding any latex
         commands, and not cleaned"""
-        word_regex = re.compile(r"(?<!\\)(?<!{)\b\w+\b(?!})")
-        self.tokens = word_regex.findall(self.text.lower())
+        self.tokens = latex_lexer.word_regex.findall(self.text.lower())
 
     def create_unique_tokens(self) -> None:
         """Uses the tokens available to create a set of unique tokens"""
@@ -92,11 +442,11 @@ class Stats:
         count comments and single-letter words also, so be careful"""
         # Regex Translation: Ignores everything preceded by \, like \chapter,
         # etc
-        self.word_count = len(self.tokens)
+        self.word_count = sum(self.word_Counter.values())
 
     def count_unique_words(self) -> None:
         """Don't consider repeated words"""
-        self.unique_word_count = len(self.unique_tokens)
+        self.unique_word_count = len(self.word_Counter)
 
     def Counter_words(self) -> None:
         """Creates a dictionary (specifically a collections.Counter) that
@@ -104,41 +454,17 @@ class Stats:
         """
         self.word_Counter = Counter(self.tokens)
 
-    def stemmatize_words(self) -> None:
-        """Get the stems of words using RSLP Stemmer"""
-        stemmer = rslp.RSLPStemmer()
-        self.stems = [stemmer.stem(word) for word in self.tokens]
-        self.unique_stems = list(
-            set([stemmer.stem(word) for word in self.unique_tokens])
-        )
-
-    def stemmatize_nonstopping_words(self) -> None:
-        """Get the stems of nonstopping words using RSLP"""
-        stemmer = rslp.RSLPStemmer()
-        self.nonstopping_stems = [stemmer.stem(word) for word in self.reduced_tokens]
-        self.unique_nonstopping_stems = list(set(self.nonstopping_stems))
-
     def stemmatize_words_(self) -> None:
-        """Get the stems of words using SnowballStemmer"""
-
-        stemmer = SnowballStemmer("portuguese")
-        self.stems = [stemmer.stem(word) for word in self.tokens]
-        self.unique_stems = list(
-            set([stemmer.stem(word) for word in self.unique_tokens])
-        )
+        """Counts the stems of words using SnowballStemmer, from the word
+        Counter. Each distinct word is stemmed only once (see stem_words)."""
+        self.stem_Counter = count_stems(self.word_Counter)
+        self.stem_count = sum(self.stem_Counter.values())
+        self.unique_stem_count = len(self.stem_Counter)
 
     def stemmatize_nonstopping_words_(self) -> None:
-        """Get the stems of nonstopping words using SnowballStemmer"""
-        stemmer = SnowballStemmer("portuguese")
-        self.nonstopping_stems = [stemmer.stem(word) for word in self.reduced_tokens]
-        self.unique_nonstopping_stems = list(set(self.nonstopping_stems))
-
-    def Counter_stems(self) -> None:
-        self.stem_Counter = Counter(self.stems)
-
-    def Counter_nonstopping_stems(self) -> None:
-        """Creates Counter object of the nonstopping stems"""
-        self.nonstopping_stem_Counter = Counter(self.nonstopping_stems)
+        """Counts the stems of nonstopping words using SnowballStemmer, from
+        the reduced word Counter"""
+        self.nonstopping_stem_Counter = count_stems(self.reduced_word_Counter)
 
     def count_equations(self) -> None:
         """Counts separately equations in the form of $ ... $ and $$ ... $$, \( ...
@@ -193,32 +519,38 @@ class Stats:
 
     def Counter_latex_environments(self) -> None:
         """Counts the number of environments such as \begin{figure}, etc """
-        # Regex translation: match everything that starts with \begin, then has an
-        # optional, noncapturing group composed of anything between [],
-        # lazily matched, and then get the environment name proper between {}.
-        latex_env_regex = re.compile(r"\\begin(?:\[.*?\])?{(\w+)}")
-        envs = latex_env_regex.findall(self.text)
-        self.env_Counter = Counter(envs)
+        # Only names that are a single word, so figure* isn't counted, like
+        # with the regex \\begin(?:\[.*?\])?{(\w+)}
+        self.env_Counter = Counter(
+            environment.name
+            for environment in self.environments().walk()
+            if re.fullmatch(r"\w+", environment.name)
+        )
 
     def Counter_number_subfigs_figures(self) -> None:
         """Adds a collections.Counter object that states how many figures with n
         subfigures there are. For example, if all n figures have no subfigures,
         then it's Counter({0: n})
         """
-        figure_env_regex = re.compile(
-            r"\\begin{figure\*?}.*?\\end{figure\*?}",
-            flags=re.MULTILINE | re.DOTALL,
-        )
-        subfigure_env_regex = re.compile(
-            r"\\begin{subfigure\*?}.*?\\end{subfigure\*?}",
-            flags=re.MULTILINE | re.DOTALL,
+        self.subfigures_in_figures_Counter = Counter(
+            len(figure.find("subfigure"))
+            for figure in self.environments().outermost("figure")
         )
-        count_subfigures = []
-        for match in figure_env_regex.finditer(self.text):
-            figure_text = match.group()
-            num_subfigures = len(subfigure_env_regex.findall(figure_text))
-            count_subfigures.append(num_subfigures)
-        self.subfigures_in_figures_Counter = Counter(count_subfigures)
+
+    def environments(self) -> latex_lexer.Environment:
+        """The tree of environments of the current text (see
+        latex_lexer.parse_environments). It's only parsed again after the text
+        changes."""
+        if getattr(self, "_environments_text", None) is not self.text:
+            self._environments = latex_lexer.parse_environments(self.text)
+            self._environments_text = self.text
+        return self._environments
+
+    def remove_environments(self, *names: str) -> None:
+        """Removes everything inside the environments with these names,
+        starred or not, including the environments inside them"""
+        spans = self.environments().spans(*names)
+        self.text = latex_lexer.remove_spans(self.text, spans)
 
     def Counter_references(self) -> None:
         """Creates a Counter object of all the references used in \cite and \citeauthor"""
@@ -271,35 +603,19 @@ class Stats:
 
     def remove_equation_envs(self) -> None:
         """Removes everything inside an equation environment """
-        equation_env_regex = re.compile(
-            r"\\begin{equation\*?}.*?\\end{equation\*?}",
-            flags=re.MULTILINE | re.DOTALL,
-        )
-        self.text = equation_env_regex.sub("", self.text)
+        self.remove_environments("equation")
 
     def remove_listing_envs(self) -> None:
         """Removes everything inside listing environments"""
-        listing_env_regex = re.compile(
-            r"\\begin{listing\*?}.*?\\end{listing\*?}",
-            flags=re.MULTILINE | re.DOTALL,
-        )
-        self.text = listing_env_regex.sub("", self.text)
+        self.remove_environments("listing")
 
     def remove_subfigure_envs(self) -> None:
         """Removes everything inside subfigures"""
-        subfigure_env_regex = re.compile(
-            r"\\begin{subfigure\*?}.*?\\end{subfigure\*?}",
-            flags=re.MULTILINE | re.DOTALL,
-        )
-        self.text = subfigure_env_regex.sub("", self.text)
+        self.remove_environments("subfigure")
 
     def remove_itemize_envs(self) -> None:
         """Removes everything inside itemize environments """
-        itemize_env_regex = re.compile(
-            r"\\begin{itemize\*?}.*?\\end{itemize\*?}",
-            flags=re.MULTILINE | re.DOTALL,
-        )
-        self.text = itemize_env_regex.sub("", self.text)
+        self.remove_environments("itemize")
 
     def remove_references(self) -> None:
         """Removes autoref and ref from the text """
@@ -329,18 +645,19 @@ class Stats:
 
     def remove_enumerate_envs(self) -> None:
         """Removes everything inside an enumerate environment"""
-        enumerate_env_regex = re.compile(
-            r"\\begin{enumerate\*?}.*?\\end{enumerate\*?}",
-            flags=re.MULTILINE | re.DOTALL,
-        )
-        self.text = enumerate_env_regex.sub("", self.text)
+        self.remove_environments("enumerate")
 
     def remove_common_words(self) -> None:
         """Removes common words (stopwords) from the word Counter object. """
 
-        stopwords = nltk.corpus.stopwords.words("portuguese")
-        self.reduced_tokens = [word for word in self.tokens if word not in stopwords]
-        self.reduced_word_Counter = Counter(self.reduced_tokens)
+        stopwords = nlp_resources.stopwords()
+        self.reduced_word_Counter = Counter(
+            {
+                word: count
+                for word, count in self.word_Counter.items()
+                if word not in stopwords
+            }
+        )
 
     def remove_words_with_numerals(self) -> None:
         """Removes words that contain numerals"""
@@ -349,6 +666,12 @@ class Stats:
         #     if not word.isalpha():
         #         self.tokens.remove(word)
 
+    def join_phrases(self) -> None:
+        """Joins the terms of Stats.phrase_counter found in the tokens into one
+        token each, so "micelas gigantes" is counted as one word and "nasal"
+        as "NaSal" (see phrase_counter.PhraseCounter)"""
+        self.tokens = self.phrase_counter.join(self.tokens)
+
     def remove_single_letter_words(self) -> None:
         """Removes words with length 1, but which aren't articles (a, e, o)"""
         acceptable_1_letter_words = ["a", "e", "o", "é", "á", "à", "ó"]
@@ -364,34 +687,9 @@ class Stats:
             )
         ]
 
-    def calculate_stats(self) -> None:
-        if self.debug:
-            self._save_intermediary_text(
-                self.debug_output_path / (self.name + "-test.txt"),
-                "original",
-                self.original_text,
-                restart=True,
-            )
-
-        # First step is to remove comments, since they don't count
-        self.remove_comments()
-        if self.debug:
-            self._save_intermediary_text(
-                self.debug_output_path / (self.name + "-test.txt"),
-                "wo comments",
-                self.text,
-            )
-
-        # For preservation
-        self.text_wo_comments = self.text[:]
-
-        # Calculate stats based on latex commands, so things like equations,
-        # cross references, etc.
-        self.Counter_latex_commands()
-        self.Counter_latex_environments()
-        self.Counter_number_subfigs_figures()
-        self.Counter_references()
-        self.count_equations()
+    def count_from_Counters(self) -> None:
+        """Sets the individual counts (chapters, figures, citations, etc) from
+        the latex command and environment Counters"""
         self.part_count = self.command_Counter[r"\part"]
         self.chapter_count = self.command_Counter[r"\chapter"]
         self.section_count = self.command_Counter[r"\section"]
@@ -414,105 +712,197 @@ class Stats:
         self.index_count = self.command_Counter[r"\index"]
         self.footnote_count = self.command_Counter[r"\footnote"]
 
-        # Counting words
-        # Text needs to be cleaned
-        self.remove_includegraphics()
-        if self.debug:
-            self._save_intermediary_text(
-                self.debug_output_path / (self.name + "-test.txt"),
-                "wo includegraphics",
-                self.text,
-            )
-        self.remove_label()
-        if self.debug:
-            self._save_intermediary_text(
-                self.debug_output_path / (self.name + "-test.txt"),
-                "wo label",
-                self.text,
-            )
-        self.remove_index()
-        if self.debug:
-            self._save_intermediary_text(
-                self.debug_output_path / (self.name + "-test.txt"),
-                "wo index",
-                self.text,
-            )
-        self.remove_citations()
-        if self.debug:
-            self._save_intermediary_text(
-                self.debug_output_path / (self.name + "-test.txt"),
-                "wo cite",
-                self.text,
-            )
-        self.remove_references()
-        if self.debug:
-            self._save_intermediary_text(
-                self.debug_output_path / (self.name + "-test.txt"),
-                "wo refs",
-                self.text,
-            )
-        self.remove_unnumbered_equations()
-        if self.debug:
-            self._save_intermediary_text(
-                self.debug_output_path / (self.name + "-test.txt"),
-                "wo unnum eq",
-                self.text,
-            )
-        self.remove_equation_envs()
-        if self.debug:
-            self._save_intermediary_text(
-                self.debug_output_path / (self.name + "-test.txt"),
-                "wo eq envs",
-                self.text,
-            )
-        self.remove_inputminted()
-        if self.debug:
-            self._save_intermediary_text(
-                self.debug_output_path / (self.name + "-test.txt"),
-                "wo inputminted",
-                self.text,
-            )
-        self.remove_subfigure_envs()
+    def remove_comments_in_one_pass(self) -> None:
+        """Same as remove_comments, but with a single regex over the whole text
+        instead of one substitution per line (see latex_lexer.remove_comments)"""
+        self.text = latex_lexer.remove_comments(self.text)
+
+    def lex_text(self) -> None:
+        """Calculates the latex Counters and equation counts and cleans the
+        text for tokenizing, all in a single scan of the text, which must
+        already be without comments (see latex_lexer.lex). Same results as
+        clean_text_with_regexes, except when a stray $, an unclosed brace or
+        the options of \\ref[...] reach past another command of the same line
+        (see the comment at the top of latex_lexer)."""
+        lexed = latex_lexer.lex(self.text)
+        self.command_Counter = Counter(lexed["commands"])
+        self.env_Counter = Counter(lexed["environments"])
+        self.subfigures_in_figures_Counter = Counter(lexed["subfigures_in_figures"])
+        self.references_Counter = lexed["references"]
+        self.old_eq_count = lexed["old_eq_count"]
+        self._old_eq_count_DEBUG = lexed["long_old_eqs"]
+        if self._old_eq_count_DEBUG:
+            print("CHECK old eq counter!")
+        self.display_eq_count = lexed["display_eq_count"]
+        self.inline_eq_count = lexed["inline_eq_count"]
+        self.eq_env_count = lexed["eq_env_count"]
+        self.subeq_env_count = lexed["subeq_env_count"]
+        self.text = lexed["clean_text"]
+
+    def clean_text_with_regexes(self) -> None:
+        """Removes comments, calculates the latex Counters and equation counts,
+        then removes commands, equations and subfigures one regex at a time
+        before tokenizing. Slower than lex_text, but with Stats.debug the text
+        after each step is saved."""
+        # Each removal, with the title of its section in the debug document
+        removals = [
+            (self.remove_includegraphics, "wo includegraphics"),
+            (self.remove_label, "wo label"),
+            (self.remove_index, "wo index"),
+            (self.remove_citations, "wo cite"),
+            (self.remove_references, "wo refs"),
+            (self.remove_unnumbered_equations, "wo unnum eq"),
+            (self.remove_equation_envs, "wo eq envs"),
+            (self.remove_inputminted, "wo inputminted"),
+            (self.remove_subfigure_envs, "wo subfigs"),
+        ]
+
+        debug_file = None
         if self.debug:
-            self._save_intermediary_text(
-                self.debug_output_path / (self.name + "-test.txt"),
-                "wo subfigs",
-                self.text,
+            debug_file = open(
+                self.debug_output_path / (self.name + "-test.txt"), "w"
             )
+            self._save_intermediary_text(debug_file, "original", self.original_text)
+        try:
+            # First step is to remove comments, since they don't count
+            self._run_stage(self.remove_comments)
+            if debug_file:
+                self._save_intermediary_text(debug_file, "wo comments", self.text)
+
+            # For preservation
+            self.text_wo_comments = self.text[:]
+
+            # Calculate stats based on latex commands, so things like equations,
+            # cross references, etc.
+            self._run_stage(self.Counter_latex_commands)
+            self._run_stage(self.Counter_latex_environments)
+            self._run_stage(self.Counter_number_subfigs_figures)
+            self._run_stage(self.Counter_references)
+            self._run_stage(self.count_equations)
+
+            # Counting words
+            # Text needs to be cleaned
+            for remove, annotation in removals:
+                self._run_stage(remove)
+                if debug_file:
+                    self._save_intermediary_text(debug_file, annotation, self.text)
+        finally:
+            if debug_file:
+                debug_file.close()
 
         # Tokenize text (split into words)
-        self.tokenize_text()
+        self._run_stage(self.tokenize_text)
+
+    def _run_stage(self, method) -> None:
+        """Runs one step of calculate_stats. If Stats.profiler is set, the step
+        is recorded there under the name of the method (see
+        stage_profiler.StageProfiler)."""
+        if self.profiler is None:
+            method()
+            return
+        with self.profiler.stage(method.__name__, self.text) as record:
+            method()
+            record["chars_out"] = len(self.text)
+
+    def calculate_stats(self) -> None:
+        if self.use_lexer and not self.debug:
+            self._run_stage(self.remove_comments_in_one_pass)
+            self.text_wo_comments = self.text[:]
+            self._run_stage(self.lex_text)
+            self._run_stage(self.tokenize_text)
+        else:
+            self.clean_text_with_regexes()
+        self._run_stage(self.count_from_Counters)
+
         # Remove words with numbers
-        self.remove_words_with_numerals()
+        self._run_stage(self.remove_words_with_numerals)
         # Remove single letter words that are not articles (like "c" in tabular
         # envs)
-        self.remove_single_letter_words()
-        # Create a unique set of words
-        self.create_unique_tokens()
+        self._run_stage(self.remove_single_letter_words)
+        # Count terms like "micelas gigantes" as single words
+        self._run_stage(self.join_phrases)
+        # Rank the words by usage
+        self._run_stage(self.Counter_words)
         # Count number of words
-        self.count_words()
+        self._run_stage(self.count_words)
         # Of these, how many are unique?
-        self.count_unique_words()
-        # Rank the words by usage
-        self.Counter_words()
+        self._run_stage(self.count_unique_words)
         # Remove stopping words
-        self.remove_common_words()
-        # Stemmatize words
-        self.stemmatize_words_()
-        # Stemmatize nonstopping words
-        self.stemmatize_nonstopping_words_()
-        # Count stems
-        self.Counter_stems()
-        # Count nonstopping stems
-        self.Counter_nonstopping_stems()
+        self._run_stage(self.remove_common_words)
+        # Stemmatize words and count the stems
+        self._run_stage(self.stemmatize_words_)
+        # Stemmatize nonstopping words and count the stems
+        self._run_stage(self.stemmatize_nonstopping_words_)
+        # Everything else comes from the Counters, so the tokens can go
+        del self.tokens
+        self._environments = self._environments_text = None
+
+    @classmethod
+    def merge(
+        cls,
+        name: str,
+        list_of_Stats: Iterable["Stats"],
+        keep_text: bool = True,
+        **kwargs,
+    ) -> "Stats":
+        """Creates a Stats object from already calculated Stats, e.g. one per
+        file, by adding up their Counters and counts, without running
+        calculate_stats again. The Stats are added one at a time, so they can
+        come from a generator and be discarded right after.
+
+            Args:
+                name (str): name of the merged Stats
+                list_of_Stats (Iterable[Stats]): calculated Stats to be merged
+                keep_text (bool, optional): joins the texts of the Stats. If
+                False, the merged Stats has empty texts, and no more than one
+                of the texts is alive at any time. Defaults to True.
+                **kwargs: passed to Stats.__init__ (date, commit_hash, etc)
+
+            Returns:
+                Stats: The merged Stats, as if calculate_stats had been run on
+                all the texts joined by newlines.
+        """
+        st = cls(name, "", **kwargs)
+        for attribute in cls._summed_attributes:
+            setattr(st, attribute, 0)
+        for attribute in cls._concatenated_attributes:
+            setattr(st, attribute, [])
+        for attribute in cls._Counter_attributes:
+            setattr(st, attribute, Counter())
+        original_texts = []
+        texts = []
+        texts_wo_comments = []
+
+        for part in list_of_Stats:
+            for attribute in cls._summed_attributes:
+                total = getattr(st, attribute) + getattr(part, attribute)
+                setattr(st, attribute, total)
+            for attribute in cls._concatenated_attributes:
+                getattr(st, attribute).extend(getattr(part, attribute))
+            for attribute in cls._Counter_attributes:
+                getattr(st, attribute).update(getattr(part, attribute))
+            if keep_text:
+                original_texts.append(part.original_text)
+                texts.append(part.text)
+                texts_wo_comments.append(part.text_wo_comments)
+
+        st.original_text = "\n".join(original_texts)
+        st.text = "\n".join(texts)
+        st.text_wo_comments = "\n".join(texts_wo_comments)
+        st._old_eq_count_DEBUG = []
+        st.count_from_Counters()
+        st.count_words()
+        st.count_unique_words()
+        st.unique_stem_count = len(st.stem_Counter)
+        return st
 
     def __str__(self) -> str:
         self.stats_text = (
             f"Stats for {self.name} - commit {self.commit_hash} - description - {self.description} - date {self.date}\n"
             f"word count: {self.word_count} \n"
             f"unique word count {self.unique_word_count}\n"
-            f"stem count {len(self.stems)}\n"
-            f"unique stem count {len(self.unique_stems)}\n"
+            f"stem count {self.stem_count}\n"
+            f"unique stem count {self.unique_stem_count}\n"
             f"--- Sectioning of the text --- \n"
             f"parts: {self.part_count} \n"
             f"chapters: {self.chapter_count} \n"
@@ -563,20 +953,13 @@ class Stats:
         ) as fhand:
             pickle.dump(self, fhand)
 
-    def _save_intermediary_text(
-        self, filename, annotation: str, text: str, restart=False
-    ) -> None:
-        if not os.path.isfile(filename):
-            mode = "w"
-        else:
-            mode = "a"
-        if restart:
-            mode = "w"
-        with open(str(filename), mode) as fhand:
-            fhand.write("-" * 80 + "\n")
-            fhand.write(annotation.center(80) + "\n")
-            fhand.write("-" * 80 + "\n")
-            fhand.write(text)
+    def _save_intermediary_text(self, fhand, annotation: str, text: str) -> None:
+        """Writes the text after one of the steps of clean_text_with_regexes to
+        the debug document, under a title"""
+        fhand.write("-" * 80 + "\n")
+        fhand.write(annotation.center(80) + "\n")
+        fhand.write("-" * 80 + "\n")
+        fhand.write(text)
 
     def save_as_csv(self) -> None:
         """Converts object into a series then saves it as a csv file. Note: If
@@ -585,12 +968,14 @@ class Stats:
         self.to_Series()
         self.series.to_csv(self.output_path / (self.name + ".csv"))
 
-    def to_Series(self) -> pd.Series:
+    def to_Series(self) -> "pd.Series":
         """Converts the class into a pandas Series object.
 
         Returns:
             pd.Series: Class converted into a Series object
         """
+        import pandas as pd
+
         data_dict = dict(
             filename=self.name,
             commit_hash=self.commit_hash,
@@ -598,8 +983,8 @@ class Stats:
             date=self.date,
             word_count=self.word_count,
             unique_word_count=self.unique_word_count,
-            stem_count=len(self.stems),
-            unique_stem_count=len(self.unique_stems),
+            stem_count=self.stem_count,
+            unique_stem_count=self.unique_stem_count,
             #       --- Sectioning of the text --- ,
             parts=self.part_count,
             chapters=self.chapter_count,
@@ -641,22 +1026,6 @@ class Stats:
         return self.series
 
 
-def fix_specific_things(stats: Stats) -> Stats:
-    # Replace nasal with NaSal
-    stats.word_Counter["NaSal"] = stats.word_Counter["nasal"]
-    stats.word_Counter["nasal"] = 0
-    stats.reduced_word_Counter["NaSal"] = stats.reduced_word_Counter["nasal"]
-    stats.reduced_word_Counter["nasal"] = 0
-    occurrence_micelas_gigantes = re.findall(r"micelas gigantes", stats.text)
-    occurrence_micelas_only = re.findall(r"micelas ?(?!gigantes)", stats.text)
-    stats.word_Counter["micelas"] = len(occurrence_micelas_only)
-    stats.word_Counter["micelas gigantes"] = len(occurrence_micelas_gigantes)
-    stats.reduced_word_Counter["micelas"] = len(occurrence_micelas_only)
-    stats.reduced_word_Counter["micelas gigantes"] = len(occurrence_micelas_gigantes)
-
-    return stats
-
-
 def usage_example():
     path = pathlib.Path(thesis_path)
     tex_files = glob.glob(str(path / "*.tex"))
@@ -696,9 +1065,79 @@ def usage_example():
     return list_of_Stats
 
 
-def create_stats_all_tex_files(commit_hash: str, description: str) -> Stats:
+# Increase whenever calculate_stats changes, so older cached Stats are not reused
+STATS_CACHE_VERSION = 6
+
+
+def stats_cache_file(
+    blob_sha: str, cache_path: Union[str, pathlib.Path] = stats_cache_path
+) -> pathlib.Path:
+    """Where stats_from_blob pickles the Stats of a blob. The name also has the
+    digest of the terms joined by Stats.phrase_counter, so the Stats are
+    calculated again when the terms change."""
+    phrases = Stats.phrase_counter.digest[:12]
+    return (
+        pathlib.Path(cache_path)
+        / f"{blob_sha}-v{STATS_CACHE_VERSION}-{phrases}.pkl"
+    )
+
+
+def stats_from_blob(
+    path: str,
+    blob_sha: str,
+    text: str,
+    cache_path: Union[str, pathlib.Path, None] = stats_cache_path,
+) -> Stats:
+    """Calculates the Stats of a single file, identified by its blob sha. Since
+    the blob sha depends only on the contents of the file, the result is
+    pickled in `cache_path` and reused by every commit (and every run) where
+    the file is unchanged.
+
+        Args:
+            path (str): path of the file in the repository, used as the name
+            blob_sha (str): git blob sha of the file contents
+            text (str): the file contents
+            cache_path (str, optional): folder of the cache. If None, nothing is
+            cached. Defaults to stats_cache_path.
+
+        Returns:
+            Stats: the calculated Stats for this file
+    """
+    if cache_path is not None:
+        cache_file = stats_cache_file(blob_sha, cache_path)
+        if cache_file.is_file():
+            with open(cache_file, "rb") as fhand:
+                return pickle.load(fhand)
+    st = Stats(path, text=text, commit_hash=blob_sha, description=path)
+    st.calculate_stats()
+    if cache_path is not None:
+        os.makedirs(cache_path, exist_ok=True)
+        # Write then rename, so an interrupted run never leaves a broken pickle
+        temporary_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(temporary_file, "wb") as fhand:
+            pickle.dump(st, fhand)
+        os.replace(temporary_file, cache_file)
+    return st
+
+
+def create_stats_all_tex_files(
+    commit_hash: str, description: str, stream: bool = False
+) -> Stats:
     path = pathlib.Path(thesis_path)
     tex_files = glob.glob(str(path / "*.tex"))
+    if stream:
+        # One file at a time, see Stats.merge
+        st = Stats.merge(
+            "all",
+            (stats_from_blob(file, None, open_file(file), None) for file in tex_files),
+            keep_text=False,
+            commit_hash=commit_hash,
+            description=description,
+            output_path=stats_basepath,
+            debug_output_path=stats_basepath,
+            number_most_common=100,
+        )
+        return st
     full_text = []
     for file in tex_files:
         text = open_file(file)
@@ -714,75 +1153,132 @@ def create_stats_all_tex_files(commit_hash: str, description: str) -> Stats:
         number_most_common=100,
     )
     st.calculate_stats()
-    st = fix_specific_things(st)
     return st
 
 
 def create_stats_from_sha(
     sha: str,
-    repo: git.Repo,
+    repo: "git.Repo",
     filename_pattern: str = "*.tex",
     merge: bool = True,
+    reader: BlobReader = None,
+    from_checkout: bool = False,
+    use_cache: bool = True,
+    stream: bool = False,
 ) -> List[Stats]:
     """Creates a stats object and computes its values starting from a commit
-    hash and a git.Repo object pointing to the repo.
+    hash and a git.Repo object pointing to the repo. By default, the files are
+    read straight from the git object database, so the working copy is left
+    untouched, and only the files that end up in the document are used,
+    following the includes from main.tex (see BlobReader.list_sources).
 
         Args:
             sha (str): The commit sha hash
             repo (git.Repo): The target repo
             filename_pattern (str, optional): The pattern used to get the
-            appropriate files. Defaults to "*.tex".
+            appropriate files. With `from_checkout`, the top level files
+            matching it are globbed, as it was done originally. Defaults to
+            "*.tex".
             merge (bool, optional): Whether or not to compute the stats for all
-            the files as one, or to compute them individually. Defaults to True.
+            the files as one, or to compute them individually. The individual
+            Stats can be added up with Stats.merge. Defaults to True.
+            reader (BlobReader, optional): An open BlobReader, to reuse the same
+            `git cat-file` process between commits. If None, one is created
+            and closed for this commit only.
+            from_checkout (bool, optional): Checks out the commit and globs the
+            working tree instead, like it was done originally. Defaults to False.
+            use_cache (bool, optional): Calculates the Stats of each file
+            separately, cached by blob sha (see stats_from_blob), and adds them
+            up when merging. Only files that changed since a previous commit
+            are actually calculated. Ignored if `from_checkout`, and when
+            merging without it, unless streaming. Defaults to True.
+            stream (bool, optional): When merging, reads and calculates one
+            file at a time and adds it to the total right away, so at most one
+            file's text is in memory. The merged Stats has no text. Defaults to
+            False.
 
         Returns:
             List[Stats]: A list containing the individual Stats for each file considered. If `merge==True`,
             then its a single item list.
     """
 
-    repo.git.checkout(sha)
-    date = repo.commit().committed_date
-
-    path = pathlib.Path(thesis_path)
-    tex_files = glob.glob(str(path / filename_pattern))
-    assert len(tex_files) >= 1
-
-    if merge:
-        list_text: List[str] = []
-        for file in tex_files:
-            text = open_file(file)
-            list_text.append(text)
-        full_text = "\n".join(list_text)
-        st = Stats(
-            f"all",
-            text=full_text,
-            commit_hash=sha,
-            description="",
-            date=date,
-            output_path=stats_basepath,
-        )
-        st.calculate_stats()
-        return [st]
-    else:
-        list_stats: List[Stats] = []
-        for file in tex_files:
-            text = open_file(file)
+    own_reader = reader is None and not from_checkout
+    if own_reader:
+        reader = BlobReader(repo.working_tree_dir)
+    try:
+        if from_checkout:
+            repo.git.checkout(sha)
+            date = repo.commit().committed_date
+            path = pathlib.Path(thesis_path)
+            files = glob.glob(str(path / filename_pattern))
+            # Generator, so each file is only read when it's needed
+            tex_files = ((file, None, open_file(file)) for file in files)
+        else:
+            date = reader.commit_date(sha)
+            files = reader.list_sources(sha, filename_pattern)
+            tex_files = reader.read_files(files)
+        assert len(files) >= 1
+
+        if merge and (stream or (use_cache and not from_checkout)):
+            cache_path = stats_cache_path if use_cache and not from_checkout else None
+            partial_stats = (
+                stats_from_blob(file, blob_sha, text, cache_path)
+                for file, blob_sha, text in tex_files
+            )
+            st = Stats.merge(
+                f"all",
+                partial_stats,
+                keep_text=not stream,
+                commit_hash=sha,
+                description="",
+                date=date,
+                output_path=stats_basepath,
+            )
+            return [st]
+        elif merge:
+            full_text = "\n".join(text for _, _, text in tex_files)
             st = Stats(
-                file,
-                text=text,
+                f"all",
+                text=full_text,
                 commit_hash=sha,
-                description=filename_pattern,
-                output_path=str(pathlib.Path(stats_basepath) / sha),
-                debug_output_path=str(pathlib.Path(stats_basepath) / sha),
+                description="",
+                date=date,
+                output_path=stats_basepath,
             )
-            list_stats.append(st)
-        return list_stats
+            st.calculate_stats()
+            return [st]
+        else:
+            list_stats: List[Stats] = []
+            output_path = pathlib.Path(stats_basepath) / sha
+            for file, blob_sha, text in tex_files:
+                if use_cache and not from_checkout:
+                    st = stats_from_blob(file, blob_sha, text)
+                else:
+                    st = Stats(
+                        file,
+                        text=text,
+                        output_path=output_path,
+                        debug_output_path=output_path,
+                    )
+                    st.calculate_stats()
+                # The cached Stats belong to the blob, not to this commit
+                st.name = file
+                st.commit_hash = sha
+                st.description = filename_pattern
+                st.date = date
+                st.output_path = st.debug_output_path = output_path
+                list_stats.append(st)
+            return list_stats
+    finally:
+        if own_reader:
+            reader.close()
 
 
 def test_all_includeonlys() -> None:
     """Tests commit by commit if there's a line containing \\includeonly. This
     needs to be removed to better represent the evolution of the pages
     """
+    import git
     from repo_info import load_commit_list
 
     commits = load_commit_list()
@@ -800,21 +1296,212 @@ def test_all_includeonlys() -> None:
             print(fr'{commit["sha"]}: Commit does not have an \includeonly statement')
 
 
-def create_all_stats() -> None:
-    """Creates a Stats class for all commits in the repository, merging all tex files"""
+# Each process of create_all_stats keeps its own repo and BlobReader
+_worker_repo = None
+_worker_reader = None
 
-    commits = load_commit_list()
-    starting_commit = commits[0]["sha"]
-    repo = git.Repo(thesis_path)
-    repo.git.checkout(starting_commit, force=True)
 
-    for i, commit in enumerate(commits):
-        print('Creating stats for', commit['sha'], f'{i+1}/{len(commits)}', flush=True)
-        st = create_stats_from_sha(
-            commit["sha"],
-            repo,
-        )[0]
-        print('\tSaving pickle', flush=True)
-        st.pickle()
-        print('\tSaving text', flush=True)
-        st.save_as_text()
+def _init_stats_worker(
+    repo_path: str, profile: bool = False, trace_memory: bool = False
+) -> None:
+    import git
+
+    global _worker_repo, _worker_reader
+    _worker_repo = git.Repo(repo_path)
+    _worker_reader = BlobReader(repo_path)
+    if profile:
+        Stats.profiler = StageProfiler(trace_memory)
+
+
+def _take_profiler_records() -> List[dict]:
+    # The records of the stages go back with the results, since each process
+    # has its own profiler
+    records = []
+    if Stats.profiler is not None:
+        records, Stats.profiler.records = Stats.profiler.records, []
+    return records
+
+
+# The workers send the words they stemmed back with the results, and the stem
+# cache is saved once, at the end of create_all_stats
+
+def _stats_worker(sha: str) -> Tuple[Stats, List[dict], dict]:
+    st = create_stats_from_sha(sha, _worker_repo, reader=_worker_reader)[0]
+    return st, _take_profiler_records(), take_new_stems()
+
+
+def _file_stats_worker(entry: Tuple[str, str]) -> Tuple[List[dict], dict]:
+    path, blob_sha = entry
+    _, _, data = _worker_reader.read(blob_sha)
+    stats_from_blob(path, blob_sha, decode_text(data))
+    return _take_profiler_records(), take_new_stems()
+
+
+def _files_to_calculate(
+    shas: List[str], reader: BlobReader, filename_pattern: str = "*.tex"
+) -> List[Tuple[str, str]]:
+    """The (path, blob sha) of every version of every file in the commits,
+    once each, that isn't in the stats cache yet"""
+    files = {}
+    for sha in shas:
+        for path, blob_sha in reader.list_sources(sha, filename_pattern):
+            if blob_sha not in files and not stats_cache_file(blob_sha).is_file():
+                files[blob_sha] = path
+    return [(path, blob_sha) for blob_sha, path in files.items()]
+
+
+def _merge_file_stats(
+    sha: str, repo: "git.Repo", reader: BlobReader
+) -> Tuple[Tuple[Stats, List[Stats]], List[dict], dict]:
+    """Adds up the Stats of the files of a commit, which must all be in the
+    stats cache already. Runs in the main process, so its stems are already in
+    the cache."""
+    files = create_stats_from_sha(sha, repo, merge=False, reader=reader)
+    st = Stats.merge(
+        "all",
+        files,
+        commit_hash=sha,
+        description="",
+        date=files[0].date,
+        output_path=stats_basepath,
+    )
+    return (st, files), [], {}
+
+
+def create_all_stats(
+    jobs: int = 1,
+    profile: bool = False,
+    trace_memory: bool = False,
+    per_file: bool = False,
+) -> None:
+    """Creates a Stats class for all commits in the repository, merging all tex
+    files, and adds them to the stats store (see stats_store.StatsStore). The
+    files are read from the git objects, so nothing is checked out. A commit
+    with the same .tex files as an earlier one (see content_hash.tex_tree_hash)
+    isn't calculated again, its Stats are copied in the store. At the end,
+    the metrics of all commits are saved in stats_basepath/history.csv (see
+    StatsStore.export_history).
+
+        Args:
+            jobs (int, optional): number of processes calculating the Stats.
+            Each one reads the files with its own BlobReader, and the results
+            are saved in the order of the commits. Defaults to 1.
+            profile (bool, optional): records the time of each step of
+            Stats.calculate_stats, for all commits, and saves a table with the
+            totals per step to stats_basepath/stage_profile.csv. Files found
+            in the stats cache aren't calculated, so they aren't recorded.
+            Defaults to False.
+            trace_memory (bool, optional): with profile, also records the peak
+            of memory allocated in each step. Slow. Defaults to False.
+            per_file (bool, optional): first calculates every version of every
+            file, once each and in parallel, into the stats cache. Then the
+            Stats of each commit are the sum of its files (see Stats.merge),
+            and the Stats of each file are also added to the store, for the
+            time series of each chapter (see StatsStore.load_file_series).
+            Defaults to False.
+    """
+
+    import git
+    from stats_store import StatsStore
+
+    commits = load_commit_list()
+    shas = [commit["sha"] for commit in commits]
+    profiler = StageProfiler(trace_memory) if profile else None
+    # Commits with the same .tex files as an earlier one are copied from it,
+    # only the first one of each is calculated. Commits without a hash (not
+    # found in the repository) are all calculated.
+    hashes = content_hashes(shas, tex_tree_hash)
+    first_with_hash = {}
+    # Hash -> number of commits still to be copied from its first one
+    pending_copies = Counter()
+    calculated_shas = []
+    for sha, key in hashes.items():
+        if key in first_with_hash:
+            pending_copies[key] += 1
+            continue
+        if key is not None:
+            first_with_hash[key] = sha
+        calculated_shas.append(sha)
+
+    if jobs > 1:
+        pool = multiprocessing.Pool(
+            jobs,
+            initializer=_init_stats_worker,
+            initargs=(thesis_path, profile, trace_memory),
+        )
+        imap = pool.imap
+    else:
+        pool = None
+        _init_stats_worker(thesis_path, profile, trace_memory)
+        imap = map
+
+    store = StatsStore()
+    reader = None
+    # Hash -> its calculated Stats, without the texts and the word Counters, to
+    # write the text files of the copies. Kept only while there are copies left,
+    # so the memory doesn't grow with the history.
+    calculated = {}
+    try:
+        if per_file:
+            repo = git.Repo(thesis_path)
+            reader = BlobReader(thesis_path)
+            files = _files_to_calculate(calculated_shas, reader)
+            for i, (records, stems) in enumerate(imap(_file_stats_worker, files)):
+                add_stems(stems)
+                print('Created stats for file', f'{i+1}/{len(files)}', flush=True)
+                if profiler is not None:
+                    profiler.records.extend(records)
+            all_stats = (_merge_file_stats(sha, repo, reader) for sha in calculated_shas)
+        else:
+            all_stats = imap(_stats_worker, calculated_shas)
+
+        for i, commit in enumerate(commits):
+            sha = commit["sha"]
+            key = hashes[sha]
+            if key is not None and first_with_hash[key] != sha:
+                print('Same .tex files as', first_with_hash[key], 'for', sha, f'{i+1}/{len(commits)}', flush=True)
+                store.copy(first_with_hash[key], sha, date=int(commit["time"]))
+                st = copy.copy(calculated[key])
+                st.commit_hash = sha
+                st.date = int(commit["time"])
+                st.save_as_text()
+                pending_copies[key] -= 1
+                if pending_copies[key] == 0:
+                    del calculated[key]
+                continue
+            st, records, stems = next(all_stats)
+            add_stems(stems)
+            if per_file:
+                st, files = st
+            print('Created stats for', sha, f'{i+1}/{len(commits)}', flush=True)
+            if profiler is not None:
+                profiler.records.extend(records)
+            print('\tSaving to the stats store', flush=True)
+            store.append(st)
+            if per_file:
+                store.append_files(files)
+            print('\tSaving text', flush=True)
+            st.save_as_text()
+            if pending_copies[key]:
+                st.original_text = st.text = st.text_wo_comments = ""
+                # Decoded again from word_ids and word_counts if needed
+                for attribute in Stats._encoded_Counters:
+                    setattr(st, "_" + attribute, None)
+                calculated[key] = st
+        print('Saving the history of the metrics', flush=True)
+        store.export_history()
+    finally:
+        save_stem_cache()
+        save_vocabulary()
+        store.close()
+        if reader is not None:
+            reader.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        else:
+            _worker_reader.close()
+            Stats.profiler = None
+        if profiler is not None and profiler.records:
+            table = profiler.save(pathlib.Path(stats_basepath) / "stage_profile.csv")
+            print(table.to_string())